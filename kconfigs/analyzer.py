@@ -1,34 +1,347 @@
 # Copyright (c) 2024, Oracle and/or its affiliates.
 # Licensed under the terms of the GNU General Public License.
 import argparse
+import array
+import base64
+import gzip
+import hashlib
 import json
+import shutil
+import subprocess
+import sys
 from configparser import ConfigParser
 from pathlib import Path
-from typing import TextIO
+from typing import Any
+from typing import Iterable
 
+import numpy as np
+
+from kconfigs.config import map_kconfig
+from kconfigs.config import parse_kconfig_fast
+from kconfigs.config import SymbolTable
+from kconfigs.diff import precompute
+from kconfigs.fetcher import DistroConfig
 from kconfigs.main import get_distros
+from kconfigs.matrix import ConfigMatrix
+from kconfigs.matrix import leaf_order
+from kconfigs.matrix import linkage
+from kconfigs.matrix import neighbours
+
+
+# Bump this whenever the summary changes form, so that an existing summary
+# doesn't get reused.
+CACHE_VERSION = 1
+# The formats of summary which index.html can read
+FORMATS = ("columnar", "json")
+
+
+def int_width(limit: int) -> int:
+    """Return the bytes per integer needed to store integers below limit"""
+    return 1 if limit <= 1 << 8 else 2 if limit <= 1 << 16 else 4
+
+
+def pack(ints: Iterable[int], width: int) -> str:
+    """Pack integers as little-endian unsigned integers, encoded in base64"""
+    arr = array.array({1: "B", 2: "H", 4: "I"}[width], ints)
+    assert arr.itemsize == width
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return base64.b64encode(arr.tobytes()).decode()
+
+
+def pack_varints(ints: list[int]) -> str:
+    """Pack increasing integers as base64 LEB128 varints of their deltas"""
+    out = bytearray()
+    prev = 0
+    for i in ints:
+        delta = i - prev
+        prev = i
+        while delta >= 0x80:
+            out.append(delta & 0x7F | 0x80)
+            delta >>= 7
+        out.append(delta)
+    return base64.b64encode(out).decode()
+
+
+def columnar_summary(
+    distro_list: list[dict[str, str | None]],
+    matrix: ConfigMatrix,
+) -> dict[str, Any]:
+    """
+    Encode the summary as one column of value codes per distro
+
+    Each distinct value is stored once, in a dictionary ordered from the most
+    common value, with code 0 reserved for null (not set). A distro's column
+    holds the code of each symbol, in the order of the symbol table, packed as
+    little-endian unsigned integers of the given width and encoded in base64.
+    """
+    return {
+        "format": "columnar",
+        "version": 1,
+        "distros": distro_list,
+        "symbols": matrix.symbols,
+        "values": matrix.values,
+        "width": int_width(len(matrix.values)),
+        "columns": [
+            base64.b64encode(matrix.column(i)).decode()
+            for i in range(len(distro_list))
+        ],
+    }
+
+
+def trigrams(symbol: str) -> set[str]:
+    return {symbol[i : i + 3] for i in range(len(symbol) - 2)}
+
+
+def write_sharded_summary(
+    distro_list: list[dict[str, str | None]],
+    matrix: ConfigMatrix,
+    shard_dir: Path,
+    shard_size: int,
+) -> None:
+    """
+    Write the summary as a set of files which a browser may load lazily
+
+    manifest.json
+      The distros, the value dictionary and the width of the value codes, as
+      for the columnar summary, along with the names of the other files, and
+      the range of symbols in each shard.
+    symbols.json
+      The sorted symbol table, for prefix search, and the number of distros
+      which have each symbol set to y, to m, unset, or to another value.
+    trigrams.json
+      For substring search, the symbols containing each trigram, as packed
+      varints (see pack_varints()).
+    shard-NNN.json
+      The columns of value codes, as for the columnar summary, but for just
+      the symbols of one shard: a range of the symbol table.
+    """
+    # Symbols other than CONFIG_* (such as UTS_RELEASE) sort among the others
+    matrix = matrix.sorted()
+    symbols = matrix.symbols
+    ndistros = len(distro_list)
+
+    files: dict[str, Any] = {}
+    shards: list[dict[str, Any]] = []
+    for offset in range(0, len(symbols), shard_size):
+        names = symbols[offset : offset + shard_size]
+        name = f"shard-{len(shards):03d}.json"
+        files[name] = {
+            "columns": [
+                base64.b64encode(
+                    matrix.column(i, offset, offset + shard_size)
+                ).decode()
+                for i in range(ndistros)
+            ]
+        }
+        shards.append(
+            {
+                "file": name,
+                "offset": offset,
+                "count": len(names),
+                "first": names[0],
+                "last": names[-1],
+            }
+        )
 
+    width = int_width(ndistros + 1)
+    aggregates = matrix.tally(axis=1)
+    files["symbols.json"] = {
+        "symbols": symbols,
+        "width": width,
+        "aggregates": {
+            k: pack(v.tolist(), width) for k, v in aggregates.items()
+        },
+    }
+
+    postings: dict[str, list[int]] = {}
+    for i, sym in enumerate(symbols):
+        for tri in trigrams(sym):
+            postings.setdefault(tri, []).append(i)
+    files["trigrams.json"] = {
+        "trigrams": {
+            tri: pack_varints(ids) for tri, ids in sorted(postings.items())
+        }
+    }
+
+    files["manifest.json"] = {
+        "format": "sharded",
+        "version": 1,
+        "distros": distro_list,
+        "values": matrix.values,
+        "width": int_width(len(matrix.values)),
+        "symbols": "symbols.json",
+        "trigrams": "trigrams.json",
+        "shards": shards,
+    }
 
-def parse_kconfig(filp: TextIO) -> dict[str, str | None]:
-    config: dict[str, str | None] = {}
-    for line in filp.readlines():
-        line = line.strip()
-        if not line:
-            continue
-        elif line.startswith("# Linux/") or not line:
-            uname = line.split()[2]
-            config["UTS_RELEASE"] = uname
-        elif line.startswith("# CONFIG_"):
-            key = line.split()[1]
-            config[key] = None
-        elif line.startswith("#"):
-            continue
-        else:
-            key, value = line.split("=", 1)
-            assert key not in config
-            config[key] = value
-    assert "UTS_RELEASE" in config
-    return config
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    for name, obj in files.items():
+        text = json.dumps(obj, separators=(",", ":"))
+        write_summary(shard_dir / name, text.encode())
+    # Remove shards left over from a larger summary
+    for path in shard_dir.glob("shard-*.json*"):
+        if path.name.split(".json")[0] + ".json" not in files:
+            path.unlink()
+
+
+def similarity(matrix: ConfigMatrix, neighbour_count: int) -> dict[str, Any]:
+    """
+    Compare every pair of distros, by the Jaccard distance of their configs
+
+    distances
+      The condensed distance matrix (as scipy's squareform() gives): the upper
+      triangle, row by row, as 16-bit little-endian integers of the distance
+      times 65535, encoded in base64.
+    neighbours
+      The nearest distros to each, as pairs of the index and the distance.
+    linkage
+      The hierarchical clustering of the distros by average linkage, as scipy
+      gives it: each row merges two clusters at a distance, to make one of the
+      given size. Clusters below the number of distros are single distros, and
+      row i makes cluster n + i.
+    order
+      The distros in the order of the leaves of the clustering, which puts
+      similar distros next to each other.
+    """
+    dist = matrix.distances()
+    merges = linkage(dist)
+    upper = dist[np.triu_indices(len(dist), 1)]
+    packed = np.round(upper * 0xFFFF).astype("<u2")
+    return {
+        "format": "similarity",
+        "version": 1,
+        "distros": matrix.distros,
+        "distances": base64.b64encode(packed.tobytes()).decode(),
+        "neighbours": [
+            [[j, round(d, 4)] for j, d in near]
+            for near in neighbours(dist, neighbour_count)
+        ],
+        "linkage": [[a, b, round(h, 4), n] for a, b, h, n in merges],
+        "order": leaf_order(len(dist), merges),
+    }
+
+
+def write_summary(output_file: Path, data: bytes) -> None:
+    """
+    Write the summary, along with gzip and brotli compressed copies of it, for
+    web servers which can serve those directly. The brotli copy is only made
+    when the brotli command is available.
+    """
+    if not output_file.exists() or output_file.read_bytes() != data:
+        output_file.write_bytes(data)
+    gz = output_file.with_name(output_file.name + ".gz")
+    gz.write_bytes(gzip.compress(data, mtime=0))
+    br = output_file.with_name(output_file.name + ".br")
+    if shutil.which("brotli"):
+        subprocess.run(
+            ["brotli", "--force", "--output", br, output_file], check=True
+        )
+    else:
+        # Don't leave a stale copy behind
+        br.unlink(missing_ok=True)
+
+
+def summarize(
+    distros: list[DistroConfig],
+    input_dir: Path,
+    output_file: Path,
+    digest_dir: Path | None = None,
+    fmt: str = "columnar",
+    shard_dir: Path | None = None,
+    shard_size: int = 1000,
+    similarity_file: Path | None = None,
+    neighbour_count: int = 5,
+    index_dir: Path | None = None,
+    diffs_file: Path | None = None,
+) -> bool:
+    """
+    Write the summary of the configs of distros in input_dir
+
+    With a digest directory, a digest of the inputs to each summary is kept
+    there. When the inputs are unchanged since the summary was last written, it
+    is left alone, and False returned.
+
+    The configs are mapped into memory and parsed into one symbol table, so
+    that the symbols and values which they share are only stored once.
+    """
+    contents = {}
+    for distro in distros:
+        config_file = input_dir / distro.unique_name / "config"
+        contents[distro.unique_name] = map_kconfig(config_file)
+
+    distro_list = [
+        {
+            "unique_name": distro.unique_name,
+            "name": distro.name,
+            "version": distro.version,
+            "arch": distro.arch,
+            "package": distro.package,
+        }
+        for distro in distros
+    ]
+
+    options = f"{CACHE_VERSION} {fmt} {shard_size} {neighbour_count}"
+    h = hashlib.sha256(options.encode())
+    h.update(json.dumps(distro_list).encode())
+    for data in contents.values():
+        h.update(hashlib.sha256(data).digest())
+    inputs_digest = h.hexdigest()
+    digest_file = None
+    if digest_dir:
+        key = hashlib.sha256(str(output_file.absolute()).encode()).hexdigest()
+        digest_file = digest_dir / f"{key}.summary"
+        if (
+            output_file.exists()
+            and (not shard_dir or (shard_dir / "manifest.json").exists())
+            and (not similarity_file or similarity_file.exists())
+            and (not index_dir or (index_dir / "matrix.json").exists())
+            and (not diffs_file or diffs_file.exists())
+            and digest_file.exists()
+            and digest_file.read_text() == inputs_digest
+        ):
+            print(f"Summary {output_file} is up to date")
+            return False
+
+    table = SymbolTable()
+    kconfigs = [parse_kconfig_fast(data, table) for data in contents.values()]
+    for data in contents.values():
+        data.close()
+    matrix = ConfigMatrix.from_parsed(list(contents), table, kconfigs)
+
+    print("not set\tyes\tmod\tother\tdistro")
+    counts = matrix.tally(axis=0)
+    for i, distro in enumerate(distros):
+        print(
+            f"{counts['unset'][i]}\t{counts['y'][i]}\t{counts['m'][i]}\t"
+            f"{counts['other'][i]}\t{distro.unique_name}"
+        )
+
+    if fmt == "json":
+        obj = {
+            "distros": distro_list,
+            "kconfigs": matrix.rows(),
+        }
+        text = json.dumps(obj)
+    else:
+        obj = columnar_summary(distro_list, matrix)
+        text = json.dumps(obj, separators=(",", ":"))
+    write_summary(output_file, text.encode())
+    if shard_dir:
+        write_sharded_summary(distro_list, matrix, shard_dir, shard_size)
+    if similarity_file:
+        obj = similarity(matrix, neighbour_count)
+        text = json.dumps(obj, separators=(",", ":"))
+        write_summary(similarity_file, text.encode())
+    if index_dir:
+        matrix.sorted().save(index_dir)
+    if diffs_file:
+        text = json.dumps(precompute(matrix, distros), separators=(",", ":"))
+        write_summary(diffs_file, text.encode())
+    if digest_file:
+        digest_file.parent.mkdir(parents=True, exist_ok=True)
+        digest_file.write_text(inputs_digest)
+    return True
 
 
 def main() -> None:
@@ -60,65 +373,77 @@ def main() -> None:
         help="Filter to only the given config.ini sections (fnmatch(3) patterns"
         "are accepted)",
     )
+    parser.add_argument(
+        "--format",
+        choices=FORMATS,
+        default="columnar",
+        help="format of the summary: compact columns of value codes, or the "
+        "original JSON object with a list of values per symbol",
+    )
+    parser.add_argument(
+        "--shard-dir",
+        help="directory for the summary split into shards, which index.html "
+        "loads lazily (default: summary/ next to the output file)",
+        type=Path,
+    )
+    parser.add_argument(
+        "--shard-size",
+        help="number of symbols in each shard of the summary",
+        type=int,
+        default=1000,
+    )
+    parser.add_argument(
+        "--similarity-file",
+        help="output JSON file for the distances between distros, their "
+        "nearest neighbours and a hierarchical clustering (default: "
+        "similarity.json next to the output file)",
+        type=Path,
+    )
+    parser.add_argument(
+        "--neighbours",
+        help="number of nearest neighbours to list for each distro",
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        "--index-dir",
+        help="directory for the index which kconfigs.query reads (default: "
+        "index/ next to the output file)",
+        type=Path,
+    )
+    parser.add_argument(
+        "--diffs-file",
+        help="output JSON file for the differences between each version of a "
+        "distro and the previous one, and between the architectures of each "
+        "version (default: diffs.json next to the output file)",
+        type=Path,
+    )
+    parser.add_argument(
+        "--digest-dir",
+        help="directory where the digests of the inputs to summaries are kept "
+        "between runs",
+        type=Path,
+        default=Path.cwd() / "save/analyzer",
+    )
 
     args = parser.parse_args()
 
     cfg = ConfigParser()
     cfg.read(args.config)
     distros = get_distros(cfg, args.filter)
-
-    kconfigs = {}
-    kconfig_keys: set[str] = set()
-    for distro in distros:
-        config_file = args.input_dir / distro.unique_name / "config"
-        with config_file.open("rt") as f:
-            kconfig = parse_kconfig(f)
-        kconfigs[distro.unique_name] = kconfig
-        kconfig_keys.update(kconfig)
-
-    print("not set\tyes\tmod\tother\tdistro")
-    kconfig_to_distro_list: dict[str, list[str | None]] = {
-        c.removeprefix("CONFIG_"): list() for c in kconfig_keys
-    }
-    distro_list = []
-    for distro in distros:
-        distro_list.append(
-            {
-                "unique_name": distro.unique_name,
-                "name": distro.name,
-                "version": distro.version,
-                "arch": distro.arch,
-                "package": distro.package,
-            }
-        )
-
-        count_missing = 0
-        count_yes = 0
-        count_mod = 0
-        count_other = 0
-
-        kconfig = kconfigs[distro.unique_name]
-        for key in kconfig_keys:
-            val = kconfig.get(key)
-            kconfig_to_distro_list[key.removeprefix("CONFIG_")].append(val)
-            if val is None:
-                count_missing += 1
-            elif val == "y":
-                count_yes += 1
-            elif val == "m":
-                count_mod += 1
-            else:
-                count_other += 1
-        print(
-            f"{count_missing}\t{count_yes}\t{count_mod}\t{count_other}\t{distro.unique_name}"
-        )
-
-    with args.output_file.open("wt") as f:
-        obj = {
-            "distros": distro_list,
-            "kconfigs": kconfig_to_distro_list,
-        }
-        json.dump(obj, f)
+    summarize(
+        distros,
+        args.input_dir,
+        args.output_file,
+        args.digest_dir,
+        args.format,
+        args.shard_dir or args.output_file.parent / "summary",
+        args.shard_size,
+        args.similarity_file or args.output_file.parent / "similarity.json",
+        args.neighbours,
+        args.index_dir or args.output_file.parent / "index",
+        args.diffs_file or args.output_file.parent / "diffs.json",
+    )
 
 
 if __name__ == "__main__":
@@ -1,9 +1,17 @@
 # Copyright (c) 2024, Oracle and/or its affiliates.
 # Licensed under the terms of the GNU General Public License.
+import asyncio
+import bz2
+import lzma
+import mmap
 import re
+import struct
+import zlib
 from asyncio.subprocess import DEVNULL
+from asyncio.subprocess import PIPE
 from pathlib import Path
 from typing import Any
+from typing import Callable
 
 import aiofiles
 from aiofiles.tempfile import TemporaryDirectory
@@ -55,7 +63,114 @@ class AndroidGkiFetcher(Fetcher):
         return (links[-1], None)
 
 
+BOOT_MAGIC = b"ANDROID!"
+# Boot image header v3 and later fix the page size rather than storing it
+BOOT_V3_PAGE_SIZE = 4096
+IKCFG_MAGIC = b"IKCFG_ST\037\213\010"
+
+
+def boot_image_kernel(img: memoryview) -> memoryview:
+    """
+    Return a view of the kernel section of an Android boot image
+
+    See include/bootimg/bootimg.h in AOSP (system/tools/mkbootimg). All header
+    versions start with the magic and the kernel size, and all of them store
+    header_version at offset 40. Versions 0-2 store the page size in their
+    header, while versions 3 and 4 use a fixed page size. In every version, the
+    kernel starts on the page following the header.
+    """
+    if len(img) < 48 or img[:8] != BOOT_MAGIC:
+        raise ValueError("not an Android boot image")
+    (kernel_size,) = struct.unpack_from("<I", img, 8)
+    (header_version,) = struct.unpack_from("<I", img, 40)
+    if header_version < 3:
+        (page_size,) = struct.unpack_from("<I", img, 36)
+    elif header_version <= 4:
+        page_size = BOOT_V3_PAGE_SIZE
+    else:
+        raise ValueError(f"unsupported boot header version {header_version}")
+    if page_size + kernel_size > len(img):
+        raise ValueError("kernel extends past the end of the boot image")
+    return img[page_size : page_size + kernel_size]
+
+
+def find_all(buf: memoryview, magic: bytes) -> list[int]:
+    # Regular expressions can search a buffer in place, unlike memoryview
+    return [m.start() for m in re.finditer(re.escape(magic), buf)]
+
+
+def gunzip_ikconfig(buf: memoryview) -> bytes | None:
+    """Decompress the IKCFG_ST payload of an uncompressed kernel, if present"""
+    for pos in find_all(buf, IKCFG_MAGIC):
+        try:
+            # The gzip stream is followed by IKCFG_ED and the rest of the
+            # kernel, which the decompressor leaves in unused_data.
+            return zlib.decompressobj(wbits=31).decompress(buf[pos + 8 :])
+        except zlib.error:
+            continue
+    return None
+
+
+Decompressor = Callable[[memoryview], bytes] | list[str]
+
+
+def decompress_with(factory: Callable[[], Any]) -> Decompressor:
+    def decompress(buf: memoryview) -> bytes:
+        return factory().decompress(buf)  # type: ignore
+
+    return decompress
+
+
+KERNEL_COMPRESSION: list[tuple[bytes, Decompressor]] = [
+    (b"\037\213\010", decompress_with(lambda: zlib.decompressobj(wbits=31))),
+    (b"\3757zXZ\000", decompress_with(lzma.LZMADecompressor)),
+    (b"BZh", decompress_with(bz2.BZ2Decompressor)),
+    (
+        b"\135\0\0\0",
+        decompress_with(lambda: lzma.LZMADecompressor(lzma.FORMAT_ALONE)),
+    ),
+    (b"\211\114\132", ["lzop", "-d"]),
+    (b"\002\041\114\030", ["lz4", "-d", "-l"]),
+    (b"\050\265\057\375", ["unzstd"]),
+]
+
+
+async def extract_ikconfig(kernel: memoryview) -> bytes:
+    """
+    Extract the kernel config from a (possibly compressed) kernel image
+
+    This is a port of the extract-ikconfig script which operates on a buffer,
+    so that we can hand it a slice of a larger file without copying it out.
+    """
+    config = gunzip_ikconfig(kernel)
+    if config is not None:
+        return config
+    for magic, decompressor in KERNEL_COMPRESSION:
+        for pos in find_all(kernel, magic):
+            if isinstance(decompressor, list):
+                proc = await asyncio.create_subprocess_exec(
+                    *decompressor, stdin=PIPE, stdout=PIPE, stderr=DEVNULL
+                )
+                # Like the script, ignore the exit status: trailing garbage
+                # after the compressed kernel is expected.
+                image, _ = await proc.communicate(kernel[pos:])
+            else:
+                try:
+                    image = decompressor(kernel[pos:])
+                except (zlib.error, lzma.LZMAError, OSError, EOFError):
+                    continue
+            config = gunzip_ikconfig(memoryview(image))
+            if config is not None:
+                return config
+    raise Exception("Cannot find kernel config")
+
+
 class AndroidGkiExtractor(Extractor):
+    def footprint(self, size: int, targets: int) -> tuple[int, int]:
+        # The boot image is unzipped, then mapped and searched in memory along
+        # with the decompressed kernel.
+        return 3 * size, 3 * size + (64 << 20)
+
     async def extract_kconfig(
         self, package: Path, output: Path, dc: DistroConfig
     ) -> None:
@@ -63,14 +178,24 @@ class AndroidGkiExtractor(Extractor):
             tdpath = Path(td)
 
             await check_call(
-                ["unzip", package],
+                ["unzip", package, "boot*.img"],
                 cwd=tdpath,
                 stdout=DEVNULL,
                 stderr=DEVNULL,
             )
 
+            # Only the kernel section is searched, rather than the ramdisk and
+            # signature blocks which follow it.
             img = next(tdpath.glob("boot*.img"))
-            extractor = Path(__file__).absolute().parent / "extract-ikconfig"
-            config = await check_call([extractor, img], capture_output=True)
+            with img.open("rb") as imgf, mmap.mmap(
+                imgf.fileno(), 0, access=mmap.ACCESS_READ
+            ) as mm, memoryview(mm) as view:
+                kernel = boot_image_kernel(view)
+                try:
+                    config = await extract_ikconfig(kernel)
+                finally:
+                    # The mmap cannot be closed while a view into it exists,
+                    # and would raise over any error of the extraction
+                    kernel.release()
             async with aiofiles.open(output, "wb") as f:
                 await f.write(config)
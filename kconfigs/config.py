@@ -0,0 +1,137 @@
+# Copyright (c) 2024, Oracle and/or its affiliates.
+# Licensed under the terms of the GNU General Public License.
+"""
+Reading the kernel configs (.config files) which the extractors write
+
+parse_kconfig() returns a config as a dict of strings. For reading the configs
+of every distro at once, parse_kconfig_fast() is quicker and smaller: it finds
+every line of interest with a single pass of a regular expression over the
+bytes of the file (mapped into memory, by map_kconfig()), and numbers each
+symbol and value in a symbol table shared by all the configs. The same few
+thousand symbols and values, which most configs set, are only decoded and
+stored once, and each config is just two arrays of numbers.
+"""
+import io
+import mmap
+import re
+from array import array
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TextIO
+
+
+def parse_kconfig(filp: TextIO) -> dict[str, str | None]:
+    config: dict[str, str | None] = {}
+    for line in filp.readlines():
+        line = line.strip()
+        if not line:
+            continue
+        elif line.startswith("# Linux/") or not line:
+            uname = line.split()[2]
+            config["UTS_RELEASE"] = uname
+        elif line.startswith("# CONFIG_"):
+            key = line.split()[1]
+            config[key] = None
+        elif line.startswith("#"):
+            continue
+        else:
+            key, value = line.split("=", 1)
+            assert key not in config
+            config[key] = value
+    assert "UTS_RELEASE" in config
+    return config
+
+
+def parse_kconfig_bytes(data: bytes) -> dict[str, str | None]:
+    return parse_kconfig(io.StringIO(data.decode()))
+
+
+# The lines of a config which set a symbol, or say that it is not set, as the
+# kernel writes them. The value is matched with its "=", so that the second
+# group tells the two apart in one pass, without a branch per kind of line.
+KCONFIG_LINE = re.compile(
+    rb"^(?:# )?(CONFIG_\w+)(=.*| is not set)$", re.MULTILINE
+)
+KCONFIG_RELEASE = re.compile(rb"^# Linux/\S+ (\S+)", re.MULTILINE)
+NOT_SET = b" is not set"
+UTS_RELEASE = b"UTS_RELEASE"
+
+
+class SymbolTable:
+    """
+    The names of the symbols, and the values, of a set of configs, each given
+    a number when it is first seen. Value 0 is null: the symbol is not set.
+    """
+
+    def __init__(self) -> None:
+        self.symbols: list[str] = []
+        self.values: list[str | None] = [None]
+        self.symbol_ids: dict[bytes, int] = {}
+        self.value_ids: dict[bytes, int] = {NOT_SET: 0}
+
+    def symbol(self, name: bytes) -> int:
+        sym = self.symbol_ids.get(name)
+        if sym is None:
+            sym = self.symbol_ids[name] = len(self.symbols)
+            self.symbols.append(name.decode())
+        return sym
+
+    def value(self, value: bytes) -> int:
+        """Number a value, as KCONFIG_LINE matches it: after an "=" sign"""
+        val = self.value_ids.get(value)
+        if val is None:
+            val = self.value_ids[value] = len(self.values)
+            self.values.append(value[1:].decode())
+        return val
+
+    def to_dict(self, config: "ParsedKconfig") -> dict[str, str | None]:
+        """Return a config as parse_kconfig() would"""
+        return {
+            self.symbols[sym]: self.values[val]
+            for sym, val in zip(config.symbols, config.values)
+        }
+
+
+@dataclass
+class ParsedKconfig:
+    """The numbers of the symbols which a config sets, and of their values"""
+
+    symbols: array  # type: ignore[type-arg]
+    values: array  # type: ignore[type-arg]
+
+
+def map_kconfig(path: Path) -> mmap.mmap:
+    """Map a config file into memory, read-only"""
+    with path.open("rb") as f:
+        if not path.stat().st_size:
+            raise Exception(f"Config {path} is empty")
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def parse_kconfig_fast(
+    data: bytes | mmap.mmap, table: SymbolTable
+) -> ParsedKconfig:
+    """
+    Parse a config, as parse_kconfig() does, numbering its symbols and values
+    in the table. As with a dict, a symbol which appears twice takes its last
+    value.
+    """
+    symbols = array("I")
+    values = array("I")
+    symbol_ids = table.symbol_ids
+    value_ids = table.value_ids
+    for key, value in KCONFIG_LINE.findall(data):
+        sym = symbol_ids.get(key)
+        if sym is None:
+            sym = table.symbol(key)
+        val = value_ids.get(value)
+        if val is None:
+            val = table.value(value)
+        symbols.append(sym)
+        values.append(val)
+    release = KCONFIG_RELEASE.search(data)
+    if release is None:
+        raise Exception("Config has no kernel release")
+    symbols.append(table.symbol(UTS_RELEASE))
+    values.append(table.value(b"=" + release.group(1)))
+    return ParsedKconfig(symbols, values)
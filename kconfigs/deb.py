@@ -10,19 +10,23 @@ from typing import Any
 import aiofiles
 from aiofiles.tempfile import TemporaryDirectory
 
+from kconfigs.decompress import fetch_cost
+from kconfigs.decompress import maybe_decompress
 from kconfigs.extractor import Extractor
 from kconfigs.fetcher import Checksum
 from kconfigs.fetcher import DistroConfig
 from kconfigs.fetcher import Fetcher
+from kconfigs.util import add_mirrors
 from kconfigs.util import download_file
 from kconfigs.util import download_file_mem_verified
-from kconfigs.util import maybe_decompress
 
 
 RPM_TO_DEB_ARCH = {
     "x86_64": "amd64",
     "aarch64": "arm64",
 }
+# The compressed formats of the Packages file which a repository may offer
+PACKAGES_FORMATS = ("xz", "zst", "gz", "bz2")
 
 
 class DebFetcher(Fetcher):
@@ -35,10 +39,12 @@ class DebFetcher(Fetcher):
         self.__latest_hash: None | str = None
         self.__packages_path: None | str = None
         self.__packages_local: None | Path = None
+        self.__sizes: dict[str, int] = {}
         self.__arch = RPM_TO_DEB_ARCH.get(dc.arch, dc.arch)
         self.__category = dc.category or "main"
         assert dc.codename is not None
         self.__codename = dc.codename
+        add_mirrors(dc.index, dc.mirrors, f"dists/{dc.codename}/Release")
         assert dc.key
         self.key = dc.key
 
@@ -56,23 +62,32 @@ class DebFetcher(Fetcher):
             url, self.key, suffix=".gpg"
         )
         data = data_bytes.decode("utf-8")
-        entry_re = re.compile(r"^\s*([0-9a-f]+)\s+\d+\s+(.*)$", re.M)
+        entry_re = re.compile(r"^\s*([0-9a-f]+)\s+(\d+)\s+(.*)$", re.M)
         ix = data.index("SHA256:\n")
-        desired_entries = [
-            f"{self.__category}/binary-{self.__arch}/Packages.xz",
-            f"{self.__category}/binary-{self.__arch}/Packages.bz2",
-            f"{self.__category}/binary-{self.__arch}/Packages.gz",
-        ]
-        file_to_hash = {
-            m.group(2): m.group(1) for m in entry_re.finditer(data, ix)
+        packages = f"{self.__category}/binary-{self.__arch}/Packages"
+        file_to_entry = {
+            m.group(3): (m.group(1), int(m.group(2)))
+            for m in entry_re.finditer(data, ix)
         }
-        for file in desired_entries:
-            if file in file_to_hash:
-                self.__latest_hash = file_to_hash[file]
-                self.__packages_path = file
-                break
-        else:
+        # The uncompressed file is usually listed, but not served: it only
+        # tells us the decompressed size of the others
+        open_size = file_to_entry.get(packages, (None, None))[1]
+        variants = []
+        for ext in PACKAGES_FORMATS:
+            file = f"{packages}.{ext}"
+            if file in file_to_entry:
+                size = file_to_entry[file][1]
+                variants.append((fetch_cost(file, size, open_size), file))
+        if not variants:
             raise Exception("Could not find Packages file")
+        # The first listed wins ties
+        cost, file = min(variants, key=lambda v: v[0])
+        print(
+            f"Metadata for {self.index} {self.__codename}: {file} "
+            f"(estimated {cost:.2f}s, of {len(variants)} variants)"
+        )
+        self.__latest_hash = file_to_entry[file][0]
+        self.__packages_path = file
 
     async def is_updated(self) -> bool:
         if not self.__latest_hash:
@@ -147,10 +162,19 @@ class DebFetcher(Fetcher):
             raise Exception("Could not find specific linux-modules package")
         url = posixpath.join(self.index, keys[pkg]["Filename"])
         checksum = ("sha256", keys[pkg]["SHA256"])
+        if "Size" in keys[pkg]:
+            self.__sizes[f"linux-{flavor}"] = int(keys[pkg]["Size"])
         return (url, checksum)
 
+    async def package_size(self, pkg: str) -> int | None:
+        return self.__sizes.get(pkg)
+
 
 class DebExtractor(Extractor):
+    def footprint(self, size: int, targets: int) -> tuple[int, int]:
+        # dpkg-deb unpacks every module in the package
+        return 6 * size, 64 << 20
+
     async def extract_kconfig(
         self, package: Path, output: Path, _: DistroConfig
     ) -> None:
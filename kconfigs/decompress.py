@@ -0,0 +1,215 @@
+# Copyright (c) 2024, Oracle and/or its affiliates.
+# Licensed under the terms of the GNU General Public License.
+"""
+Decompressing package metadata and tarballs
+
+Each format has a list of commands which decompress it to stdout, fastest
+first, and the first one installed is used: the parallel decoders (pigz,
+lbzip2, pbzip2, and xz with threads, which decodes multi-block files in
+parallel) where available, or else the standard ones.
+
+A file may be decompressed next to itself, by maybe_decompress(), which keeps
+the output until the input changes, or streamed to a consumer, by
+decompress_stream(). To compare the decoders on some files:
+
+    python -m kconfigs.decompress primary.sqlite.xz Packages.gz
+    python -m kconfigs.decompress --sample linux.tar
+
+The second form compresses the sample with each format first.
+
+Where a repository offers its metadata in several formats, fetch_cost()
+estimates the time to download and decompress each one, from its published
+sizes, so that the fetchers can choose the cheapest.
+"""
+import argparse
+import asyncio
+import hashlib
+import shutil
+import subprocess
+import tempfile
+import time
+from asyncio.subprocess import create_subprocess_exec
+from asyncio.subprocess import PIPE
+from asyncio.subprocess import Process
+from functools import cache
+from pathlib import Path
+from typing import Any
+
+# Commands to decompress each format to stdout, fastest first
+DECOMPRESSORS = {
+    "xz": [["xz", "-dc", "-T0"]],
+    "bz2": [["lbzip2", "-dc"], ["pbzip2", "-dc"], ["bzip2", "-dc"]],
+    "gz": [["pigz", "-dc"], ["gzip", "-dc"]],
+    # zstd decodes in one thread, however it's asked to
+    "zst": [["zstd", "-dcq"]],
+    "zstd": [["zstd", "-dcq"]],
+}
+# Commands to make samples of each format for the benchmark
+COMPRESSORS = {
+    "xz": ["xz", "-c", "-T0"],
+    "bz2": ["bzip2", "-c"],
+    "gz": ["gzip", "-c"],
+    "zst": ["zstd", "-c", "-q", "-T0"],
+}
+# Rough seconds per byte of output of the decoders above, on one core of a
+# typical machine: only the relative costs matter much
+DECODE_RATES = {
+    "xz": 1 / (100 << 20),
+    "bz2": 1 / (40 << 20),
+    "gz": 1 / (300 << 20),
+    "zst": 1 / (1000 << 20),
+    "zstd": 1 / (1000 << 20),
+}
+# Rough seconds per byte downloaded from a repository
+DOWNLOAD_RATE = 1 / (10 << 20)
+# Metadata decompresses to about this many times its size, when the
+# decompressed size is not published
+DEFAULT_RATIO = 5
+
+
+def compression(file: Path) -> str | None:
+    split = file.name.rsplit(".", 1)
+    if len(split) == 2 and split[1] in DECOMPRESSORS:
+        return split[1]
+    return None
+
+
+@cache
+def decompress_command(ext: str) -> list[str]:
+    """Return the fastest installed command to decompress a format"""
+    for cmd in DECOMPRESSORS[ext]:
+        if shutil.which(cmd[0]):
+            return cmd
+    raise Exception(f"No command to decompress .{ext} files")
+
+
+def fetch_cost(name: str, size: int, open_size: int | None = None) -> float:
+    """
+    Estimate the seconds to download a file of this size, and decompress it
+    to open_size bytes, if it is compressed. Files without an installed
+    decoder cost infinitely much.
+    """
+    cost = size * DOWNLOAD_RATE
+    ext = compression(Path(name))
+    if ext:
+        try:
+            decompress_command(ext)
+        except Exception:
+            return float("inf")
+        cost += (open_size or size * DEFAULT_RATIO) * DECODE_RATES[ext]
+    return cost
+
+
+def file_sha256(file: Path) -> str:
+    with file.open("rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+async def decompress_stream(file: Path, **kwargs: Any) -> Process:
+    """
+    Start decompressing a file, to the stdout of the returned process (a pipe,
+    unless kwargs say otherwise). The caller must wait for the process.
+    """
+    ext = compression(file)
+    assert ext, f"{file} is not compressed"
+    kwargs.setdefault("stdout", PIPE)
+    return await create_subprocess_exec(
+        *decompress_command(ext), file, **kwargs
+    )
+
+
+async def maybe_decompress(file: Path) -> Path:
+    """
+    Decompress a file next to itself, unless it isn't compressed, returning the
+    decompressed file. This is skipped when the input has the same checksum as
+    when it was last decompressed, which is noted in a .sha256 file.
+    """
+    ext = compression(file)
+    if not ext:
+        return file
+
+    decomp = file.parent / file.name[: -1 - len(ext)]
+    stamp = decomp.with_name(decomp.name + ".sha256")
+    digest = await asyncio.to_thread(file_sha256, file)
+    if decomp.exists() and stamp.exists() and stamp.read_text() == digest:
+        return decomp
+    stamp.unlink(missing_ok=True)
+    tmp = decomp.with_name(decomp.name + ".tmp")
+    with tmp.open("wb") as out:
+        proc = await decompress_stream(file, stdout=out, stderr=PIPE)
+        _, stderr = await proc.communicate()
+    if await proc.wait() != 0:
+        tmp.unlink()
+        raise Exception(f"Failed to decompress {file}: {stderr.decode()}")
+    tmp.rename(decomp)
+    stamp.write_text(digest)
+    return decomp
+
+
+def benchmark(file: Path, runs: int) -> None:
+    """Print the time each installed decoder for a file's format takes"""
+    ext = compression(file)
+    assert ext, f"{file} is not compressed"
+    size = file.stat().st_size
+    for cmd in DECOMPRESSORS[ext]:
+        if not shutil.which(cmd[0]):
+            print(f"{file.name}\t{' '.join(cmd)}\tnot installed")
+            continue
+        best = float("inf")
+        out_size = 0
+        for _ in range(runs):
+            start = time.perf_counter()
+            proc = subprocess.run(cmd + [str(file)], capture_output=True)
+            best = min(best, time.perf_counter() - start)
+            if proc.returncode != 0:
+                raise Exception(f"{cmd[0]} failed: {proc.stderr.decode()}")
+            out_size = len(proc.stdout)
+        print(
+            f"{file.name}\t{' '.join(cmd)}\t{best:.3f}s\t"
+            f"{size / best / 1e6:.0f} MB/s in\t"
+            f"{out_size / best / 1e6:.0f} MB/s out"
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Time the decompressors of compressed files"
+    )
+    parser.add_argument(
+        "files",
+        nargs="+",
+        type=Path,
+        help="compressed files, named by their format (.xz, .gz, ...)",
+    )
+    parser.add_argument(
+        "--sample",
+        action="store_true",
+        help="the files are uncompressed: compress each one in every format, "
+        "and time those",
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=3,
+        help="time the best of this many runs",
+    )
+    args = parser.parse_args()
+
+    if not args.sample:
+        for file in args.files:
+            benchmark(file, args.runs)
+        return
+    with tempfile.TemporaryDirectory() as td:
+        for file in args.files:
+            for ext, cmd in COMPRESSORS.items():
+                if not shutil.which(cmd[0]):
+                    continue
+                sample = Path(td) / f"{file.name}.{ext}"
+                with file.open("rb") as f, sample.open("wb") as out:
+                    subprocess.run(cmd, stdin=f, stdout=out, check=True)
+                benchmark(sample, args.runs)
+                sample.unlink()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+# Copyright (c) 2024, Oracle and/or its affiliates.
+# Licensed under the terms of the GNU General Public License.
+"""
+Compare the configs of two distros, symbol by symbol
+
+A diff holds the symbols which the new config sets and the old does not
+(added), those which the old sets and the new does not (removed), and those
+which both set, to different values (changed). Unlike diff(1) on the config
+files, the order of the symbols in each file makes no difference.
+
+    python -m kconfigs.diff "Oracle Linux 9 (UEK 7) x86_64" \\
+        "Oracle Linux 9 (UEK 8) x86_64"
+
+Or, from the history, the last change to a distro's config:
+
+    python -m kconfigs.diff --history history.db "Oracle Linux 9 (UEK 8) x86_64"
+
+The analyzer also compares the pairs of distros most often asked about, and
+writes them to diffs.json: each version of a distro against the previous one,
+and each architecture of a distro version against x86_64.
+"""
+import argparse
+import json
+import re
+from dataclasses import dataclass
+from dataclasses import field
+from pathlib import Path
+from typing import Any
+from typing import Mapping
+
+import numpy as np
+
+from kconfigs.fetcher import DistroConfig
+from kconfigs.history import History
+from kconfigs.matrix import ConfigMatrix
+
+# The architecture which the others are compared against
+BASE_ARCH = "x86_64"
+
+
+@dataclass
+class ConfigDiff:
+    old: str
+    new: str
+    added: dict[str, str] = field(default_factory=dict)
+    removed: dict[str, str] = field(default_factory=dict)
+    changed: dict[str, tuple[str, str]] = field(default_factory=dict)
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            "old": self.old,
+            "new": self.new,
+            "added": self.added,
+            "removed": self.removed,
+            "changed": {k: list(v) for k, v in self.changed.items()},
+        }
+
+    def lines(self) -> list[str]:
+        """Return the diff as text, a line per symbol in order of name"""
+        out = []
+        for sym in sorted({*self.added, *self.removed, *self.changed}):
+            # UTS_RELEASE is not a real symbol, but the kernel release
+            name = sym if sym == "UTS_RELEASE" else f"CONFIG_{sym}"
+            if sym in self.added:
+                out.append(f"+{name}={self.added[sym]}")
+            elif sym in self.removed:
+                out.append(f"-{name}={self.removed[sym]}")
+            else:
+                old, new = self.changed[sym]
+                out.append(f"~{name}={old} -> {new}")
+        return out
+
+
+def diff_configs(
+    old: str,
+    new: str,
+    old_config: Mapping[str, str | None],
+    new_config: Mapping[str, str | None],
+) -> ConfigDiff:
+    """Compare two parsed configs, such as those kept in the history"""
+    diff = ConfigDiff(old, new)
+    for key in old_config.keys() | new_config.keys():
+        sym = key.removeprefix("CONFIG_")
+        a = old_config.get(key)
+        b = new_config.get(key)
+        if a == b:
+            continue
+        elif a is None:
+            assert b is not None
+            diff.added[sym] = b
+        elif b is None:
+            diff.removed[sym] = a
+        else:
+            diff.changed[sym] = (a, b)
+    return diff
+
+
+def diff_distros(matrix: ConfigMatrix, old: int, new: int) -> ConfigDiff:
+    """Compare the configs of two distros, by their columns of the matrix"""
+    a = matrix.codes[:, old]
+    b = matrix.codes[:, new]
+    diff = ConfigDiff(matrix.distros[old], matrix.distros[new])
+    values = matrix.values
+    for i in np.flatnonzero(a != b).tolist():
+        sym = matrix.symbols[i]
+        va = values[a[i]]
+        vb = values[b[i]]
+        if va is None:
+            assert vb is not None
+            diff.added[sym] = vb
+        elif vb is None:
+            diff.removed[sym] = va
+        else:
+            diff.changed[sym] = (va, vb)
+    return diff
+
+
+def version_key(version: str) -> list[tuple[int, str]]:
+    """Sort versions with their numbers in numeric order: 6.10 after 6.9"""
+    return [
+        (int(part), "") if part.isdigit() else (-1, part)
+        for part in re.split(r"(\d+)", version)
+        if part
+    ]
+
+
+def release_key(version: str | None) -> tuple[bool, list[tuple[int, str]]]:
+    """
+    Sort the releases of a kernel line in order, with rolling releases, which
+    have no version number (such as Rawhide), after all the numbered ones
+    """
+    version = version or ""
+    rolling = not any(c.isdigit() for c in version)
+    return (rolling, version_key(version))
+
+
+def related_pairs(
+    distros: list[DistroConfig],
+) -> list[tuple[str, DistroConfig, DistroConfig]]:
+    """
+    Return the pairs of distros most worth comparing, as (kind, old, new):
+    "version" pairs of each version of a distro and the one before it, on the
+    same architecture and kernel line (the same fetcher and package), and
+    "arch" pairs of x86_64 (or else the first of the architectures) and each
+    other architecture of the same distro version
+    """
+    pairs = []
+    by_line: dict[tuple[str, str, str, str], list[DistroConfig]] = {}
+    by_version: dict[tuple[str, str | None, str], list[DistroConfig]] = {}
+    for d in distros:
+        by_line.setdefault((d.name, d.arch, d.fetcher, d.package), []).append(d)
+        by_version.setdefault((d.name, d.version, d.fetcher), []).append(d)
+    for group in by_line.values():
+        group.sort(key=lambda d: release_key(d.version))
+        for old, new in zip(group, group[1:]):
+            pairs.append(("version", old, new))
+    for group in by_version.values():
+        group.sort(key=lambda d: (d.arch != BASE_ARCH, d.arch))
+        for other in group[1:]:
+            pairs.append(("arch", group[0], other))
+    return pairs
+
+
+def precompute(
+    matrix: ConfigMatrix, distros: list[DistroConfig]
+) -> dict[str, Any]:
+    """Return the diffs of the related pairs of distros, for diffs.json"""
+    index = {name: i for i, name in enumerate(matrix.distros)}
+    diffs = []
+    for kind, old, new in related_pairs(distros):
+        diff = diff_distros(
+            matrix, index[old.unique_name], index[new.unique_name]
+        )
+        diffs.append({"kind": kind, **diff.to_json()})
+    return {"format": "diffs", "version": 1, "diffs": diffs}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Compare the kernel configs of two distros"
+    )
+    parser.add_argument(
+        "old",
+        help="unique name of the distro to compare against",
+    )
+    parser.add_argument(
+        "new",
+        nargs="?",
+        help="unique name of the distro to compare (with --history, leave this "
+        "out to compare the last two configs of the first distro)",
+    )
+    parser.add_argument(
+        "--index-dir",
+        type=Path,
+        default=Path.cwd() / "out/index",
+        help="directory of the index written by kconfigs.analyzer",
+    )
+    parser.add_argument(
+        "--history",
+        type=Path,
+        help="compare the latest configs recorded in this history database, "
+        "rather than those in the index",
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="print the diff as JSON",
+    )
+    args = parser.parse_args()
+
+    if args.history:
+        history = History(args.history)
+        if args.new:
+            latest = [history.latest(args.old), history.latest(args.new)]
+            snapshots = [s for s in latest if s is not None]
+        else:
+            snapshots = history.snapshots(args.old)[-2:]
+        if len(snapshots) < 2:
+            raise Exception("Not enough configs in the history to compare")
+        old, new = snapshots
+        diff = diff_configs(
+            history.describe(old),
+            history.describe(new),
+            history.config(old),
+            history.config(new),
+        )
+        history.close()
+    else:
+        if not args.new:
+            parser.error("the new distro is required, without --history")
+        matrix = ConfigMatrix.load(args.index_dir)
+        index = {name: i for i, name in enumerate(matrix.distros)}
+        for name in (args.old, args.new):
+            if name not in index:
+                raise Exception(f'Distro "{name}" is not in the index')
+        diff = diff_distros(matrix, index[args.old], index[args.new])
+    if args.json:
+        print(json.dumps(diff.to_json(), indent=4))
+    else:
+        for line in diff.lines():
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -11,6 +11,8 @@ from kconfigs.util import gpg_verify
 
 class Extractor(abc.ABC):
     name: str
+    # A directory which extractors may use for caching data across runs
+    savedir: Path
 
     async def verify_signature(
         self, package: Path, sig: Path, dc: DistroConfig
@@ -28,6 +30,31 @@ class Extractor(abc.ABC):
     ) -> None:
         """Extract the kconfig from the package into the output file"""
 
+    async def extract_kconfigs(
+        self, package: Path, targets: list[tuple[Path, DistroConfig]]
+    ) -> None:
+        """
+        Extract the kconfigs of several distros which share one package
+
+        By default, this extracts each one in turn. Override this if the
+        extractor can share work between the targets.
+        """
+        for output, dc in targets:
+            await self.extract_kconfig(package, output, dc)
+
+    def footprint(self, size: int, targets: int) -> tuple[int, int]:
+        """
+        Estimate the disk space and memory needed to handle a package
+
+        :param size: the size of the package in bytes
+        :param targets: the number of distros extracted from the package
+        :returns: a tuple of (disk bytes, memory bytes), which covers the
+          downloaded package along with anything that verification and
+          extraction unpack or hold in memory. The default assumes that the
+          package is unpacked in full, at a few times its compressed size.
+        """
+        return 4 * size, 64 << 20
+
     @classmethod
     @cache
     def get(cls, kind: str) -> "Extractor":
@@ -25,6 +25,8 @@ class DistroConfig:
     fetcher: str
     extractor: str
     index: str
+    # Other base URLs of the same repository, separated by whitespace
+    mirrors: str | None = None
     do_update: bool = True
     version: str | None = None
     key: str | None = None
@@ -32,6 +34,8 @@ class DistroConfig:
     codename: str | None = None
     category: str | None = None
     repo: str | None = None
+    # Seconds between checks of the index by kconfigs.watch
+    poll_interval: int | None = None
 
     @property
     def unique_name(self) -> str:
@@ -119,6 +123,15 @@ class Fetcher(abc.ABC):
         """Return the url of the GPG signature for the latest version"""
         return None
 
+    async def package_size(self, _: str) -> int | None:
+        """
+        Return the size in bytes of the latest version of package, if known
+
+        This is called after ``latest_version_url()``. Override it when the
+        package index records sizes, which saves a HEAD request per package.
+        """
+        return None
+
     @classmethod
     @cache
     def get(cls, kind: str) -> Type["Fetcher"]:
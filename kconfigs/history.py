@@ -0,0 +1,326 @@
+# Copyright (c) 2024, Oracle and/or its affiliates.
+# Licensed under the terms of the GNU General Public License.
+"""
+An append-only history of every config extracted
+
+Only the latest config of each distro is kept in the output directory, so this
+records each one in an SQLite database as it is extracted: a snapshot, keyed by
+the distro, package URL and UTS_RELEASE, holding just the symbols which changed
+since the distro's previous snapshot. Every so often a snapshot also keeps the
+full config, so that rebuilding a config replays a bounded number of deltas.
+
+Indexes on the distro and time of snapshots, and on the symbol of changes,
+answer "when did CONFIG_X change in distro Y" directly from the deltas:
+
+    python -m kconfigs.history history.db "Oracle Linux 9 (UEK 8) x86_64" CONFIG_X
+"""
+import argparse
+import calendar
+import sqlite3
+import time
+from pathlib import Path
+
+from kconfigs.config import parse_kconfig_bytes
+
+# A snapshot keeps the full config once this many deltas follow the last one
+KEYFRAME_INTERVAL = 32
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshot (
+    id INTEGER PRIMARY KEY,
+    distro TEXT NOT NULL,
+    url TEXT NOT NULL,
+    uts_release TEXT NOT NULL,
+    recorded REAL NOT NULL,
+    -- The snapshot holding the full config which this one's deltas follow,
+    -- or null if this one holds the full config
+    keyframe INTEGER REFERENCES snapshot (id),
+    UNIQUE (distro, url, uts_release)
+);
+CREATE INDEX IF NOT EXISTS snapshot_time ON snapshot (distro, recorded);
+CREATE TABLE IF NOT EXISTS symbol (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+-- The symbols which differ from the distro's previous snapshot: a null value
+-- means that the symbol is no longer set
+CREATE TABLE IF NOT EXISTS change (
+    snapshot INTEGER NOT NULL REFERENCES snapshot (id),
+    symbol INTEGER NOT NULL REFERENCES symbol (id),
+    value TEXT,
+    PRIMARY KEY (snapshot, symbol)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS change_symbol ON change (symbol, snapshot);
+-- The full config of keyframe snapshots
+CREATE TABLE IF NOT EXISTS keyframe (
+    snapshot INTEGER NOT NULL REFERENCES snapshot (id),
+    symbol INTEGER NOT NULL REFERENCES symbol (id),
+    value TEXT NOT NULL,
+    PRIMARY KEY (snapshot, symbol)
+) WITHOUT ROWID;
+"""
+
+
+def symbol_values(config: dict[str, str | None]) -> dict[str, str]:
+    """Return the symbols which a parsed config sets, without CONFIG_"""
+    return {
+        key.removeprefix("CONFIG_"): value
+        for key, value in config.items()
+        if value is not None and key != "UTS_RELEASE"
+    }
+
+
+class History:
+    def __init__(self, path: Path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+        self.symbols: dict[str, int] = dict(
+            self.db.execute("SELECT name, id FROM symbol")
+        )
+
+    def close(self) -> None:
+        self.db.close()
+
+    def symbol_id(self, name: str) -> int:
+        if name not in self.symbols:
+            cur = self.db.execute(
+                "INSERT INTO symbol (name) VALUES (?)", (name,)
+            )
+            assert cur.lastrowid is not None
+            self.symbols[name] = cur.lastrowid
+        return self.symbols[name]
+
+    def latest(self, distro: str, before: float | None = None) -> int | None:
+        """
+        Return the distro's last snapshot (of those recorded before a time).
+        Snapshots are ordered by id, as their deltas are, since the clocks of
+        the machines which recorded them need not agree.
+        """
+        if before is None:
+            row = self.db.execute(
+                "SELECT id FROM snapshot WHERE distro = ? "
+                "ORDER BY id DESC LIMIT 1",
+                (distro,),
+            ).fetchone()
+        else:
+            row = self.db.execute(
+                "SELECT id FROM snapshot WHERE distro = ? AND recorded <= ? "
+                "ORDER BY id DESC LIMIT 1",
+                (distro, before),
+            ).fetchone()
+        return row[0] if row else None
+
+    def snapshots(self, distro: str) -> list[int]:
+        """Return the distro's snapshots, from the first recorded"""
+        rows = self.db.execute(
+            "SELECT id FROM snapshot WHERE distro = ? ORDER BY id",
+            (distro,),
+        )
+        return [row[0] for row in rows]
+
+    def describe(self, snapshot: int) -> str:
+        distro, uts_release, recorded = self.db.execute(
+            "SELECT distro, uts_release, recorded FROM snapshot WHERE id = ?",
+            (snapshot,),
+        ).fetchone()
+        return f"{distro} {uts_release} ({timestamp(recorded)})"
+
+    def config(self, snapshot: int) -> dict[str, str]:
+        """Rebuild the symbols set by a snapshot, from its keyframe"""
+        row = self.db.execute(
+            "SELECT keyframe FROM snapshot WHERE id = ?", (snapshot,)
+        ).fetchone()
+        if not row:
+            raise Exception(f"No snapshot {snapshot} in the history")
+        keyframe = row[0] or snapshot
+        config = dict(
+            self.db.execute(
+                "SELECT name, value FROM keyframe "
+                "JOIN symbol ON symbol.id = keyframe.symbol "
+                "WHERE snapshot = ?",
+                (keyframe,),
+            )
+        )
+        deltas = self.db.execute(
+            "SELECT name, value FROM snapshot "
+            "JOIN change ON change.snapshot = snapshot.id "
+            "JOIN symbol ON symbol.id = change.symbol "
+            "WHERE keyframe = ? AND snapshot.id <= ? ORDER BY snapshot.id",
+            (keyframe, snapshot),
+        )
+        for name, value in deltas:
+            if value is None:
+                config.pop(name, None)
+            else:
+                config[name] = value
+        return config
+
+    def record(
+        self,
+        distro: str,
+        url: str,
+        config: dict[str, str | None],
+        recorded: float | None = None,
+    ) -> bool:
+        """
+        Record a distro's config, as extracted from the package at url
+
+        Return False if this config of the distro was already recorded.
+        """
+        uts_release = config["UTS_RELEASE"]
+        assert uts_release is not None
+        if self.db.execute(
+            "SELECT 1 FROM snapshot "
+            "WHERE distro = ? AND url = ? AND uts_release = ?",
+            (distro, url, uts_release),
+        ).fetchone():
+            return False
+
+        values = symbol_values(config)
+        previous = self.latest(distro)
+        old: dict[str, str] = {}
+        keyframe = None
+        if previous is not None:
+            old = self.config(previous)
+            (keyframe,) = self.db.execute(
+                "SELECT coalesce(keyframe, id) FROM snapshot WHERE id = ?",
+                (previous,),
+            ).fetchone()
+            (deltas,) = self.db.execute(
+                "SELECT count(*) FROM snapshot WHERE keyframe = ?",
+                (keyframe,),
+            ).fetchone()
+            if deltas >= KEYFRAME_INTERVAL:
+                keyframe = None
+
+        changes: list[tuple[str, str | None]] = [
+            (k, v) for k, v in values.items() if old.get(k) != v
+        ]
+        changes += [(k, None) for k in old if k not in values]
+        with self.db:
+            cur = self.db.execute(
+                "INSERT INTO snapshot "
+                "(distro, url, uts_release, recorded, keyframe) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    distro,
+                    url,
+                    uts_release,
+                    time.time() if recorded is None else recorded,
+                    keyframe,
+                ),
+            )
+            snapshot = cur.lastrowid
+            assert snapshot is not None
+            if keyframe is None:
+                self.db.executemany(
+                    "INSERT INTO keyframe VALUES (?, ?, ?)",
+                    [
+                        (snapshot, self.symbol_id(k), v)
+                        for k, v in values.items()
+                    ],
+                )
+            self.db.executemany(
+                "INSERT INTO change VALUES (?, ?, ?)",
+                [(snapshot, self.symbol_id(k), v) for k, v in changes],
+            )
+        return True
+
+    def record_file(self, distro: str, url: str, path: Path) -> bool:
+        return self.record(distro, url, parse_kconfig_bytes(path.read_bytes()))
+
+    def merge(self, other: "History") -> int:
+        """
+        Record the snapshots of another history, such as that of a shard of a
+        run, which this one lacks. Each is rebuilt and recorded again, in the
+        order of its id, so that its ids, and its deltas, follow this
+        history's own. Return the number of snapshots added.
+        """
+        rows = other.db.execute(
+            "SELECT id, distro, url, uts_release, recorded FROM snapshot "
+            "ORDER BY id"
+        ).fetchall()
+        added = 0
+        for snapshot, distro, url, uts_release, recorded in rows:
+            config: dict[str, str | None] = {**other.config(snapshot)}
+            config["UTS_RELEASE"] = uts_release
+            added += self.record(distro, url, config, recorded)
+        return added
+
+    def changes(
+        self, distro: str, symbol: str
+    ) -> list[tuple[float, str, str, str | None]]:
+        """
+        Return when a distro's symbol changed: the time, package URL and
+        UTS_RELEASE of each snapshot which changed it, and its new value
+        """
+        symbol = symbol.removeprefix("CONFIG_")
+        if symbol not in self.symbols:
+            return []
+        return self.db.execute(
+            "SELECT recorded, url, uts_release, value FROM change "
+            "JOIN snapshot ON snapshot.id = change.snapshot "
+            "WHERE symbol = ? AND distro = ? ORDER BY snapshot.id",
+            (self.symbols[symbol], distro),
+        ).fetchall()
+
+
+def timestamp(t: float) -> str:
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(t))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Show the history of a distro's config"
+    )
+    parser.add_argument(
+        "history",
+        type=Path,
+        help="history database written by kconfigs.main --history",
+    )
+    parser.add_argument(
+        "distro",
+        help="unique name of the distro",
+    )
+    parser.add_argument(
+        "symbols",
+        nargs="*",
+        help="show when each of these symbols changed, rather than the config",
+    )
+    parser.add_argument(
+        "--at",
+        help="show the config as of this UTC date, such as 2024-06-01 "
+        "(default: the latest)",
+    )
+    args = parser.parse_args()
+
+    if not args.history.exists():
+        raise Exception(f"No history database at {args.history}")
+    history = History(args.history)
+    if args.symbols:
+        for symbol in args.symbols:
+            name = "CONFIG_" + symbol.removeprefix("CONFIG_")
+            for recorded, url, uts_release, value in history.changes(
+                args.distro, symbol
+            ):
+                if value is None:
+                    line = f"# {name} is not set"
+                else:
+                    line = f"{name}={value}"
+                print(f"{timestamp(recorded)} {uts_release} {line}")
+                print(f"    {url}")
+    else:
+        before = None
+        if args.at:
+            day = time.strptime(args.at, "%Y-%m-%d")
+            before = calendar.timegm(day) + 24 * 60 * 60  # the end of the day
+        snapshot = history.latest(args.distro, before)
+        if snapshot is None:
+            raise Exception(f'No history of "{args.distro}" at that time')
+        for name, value in sorted(history.config(snapshot).items()):
+            print(f"CONFIG_{name}={value}")
+    history.close()
+
+
+if __name__ == "__main__":
+    main()
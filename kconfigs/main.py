@@ -3,24 +3,56 @@
 import argparse
 import asyncio
 import configparser
-import json
+import contextlib
+import heapq
+import itertools
 import multiprocessing
+import os
 import posixpath
+import re
 import shutil
+import sys
+import time
+import traceback
+from dataclasses import astuple
+from dataclasses import dataclass
+from dataclasses import field
+from dataclasses import replace
 from fnmatch import fnmatch
 from pathlib import Path
 from typing import Any
+from typing import AsyncIterator
+from typing import Awaitable
+from typing import Callable
+from typing import Protocol
+from typing import TypeVar
 
 from kconfigs.extractor import Extractor
+from kconfigs.fetcher import Checksum
 from kconfigs.fetcher import DistroConfig
 from kconfigs.fetcher import Fetcher
+from kconfigs.history import History
+from kconfigs.state import State
 from kconfigs.util import download_file
 from kconfigs.util import download_manager
+from kconfigs.util import head_file
 
 
-# Extraction is CPU-bound, and it also consumes quite a bit of disk space.
-# Limit the number of CPUs which can do extraction in parallel.
-extract_sem = asyncio.Semaphore(multiprocessing.cpu_count() + 1)
+T = TypeVar("T")
+U = TypeVar("U")
+
+# The size assumed for a package whose size cannot be determined
+UNKNOWN_SIZE = 256 << 20
+# The seconds per byte assumed for an extractor with no history in the state:
+# 20 MiB/s, across download, verification and extraction
+DEFAULT_RATE = 1 / (20 << 20)
+# Distro state which is carried over for scheduling later runs
+HISTORY = ("size", "duration")
+
+
+def fetcher_key(dc: DistroConfig) -> tuple[str, str]:
+    """Return the key of the fetcher which a distro shares with others"""
+    return (dc.fetcher, Fetcher.get(dc.fetcher).uid(dc))
 
 
 class FetcherFactory:
@@ -44,54 +76,577 @@ class FetcherFactory:
             )
         return self.registry[(dc.fetcher, uid)]
 
-    def save_state(self) -> dict[str, dict[str, Any]]:
-        new_state: dict[str, dict[str, dict[str, Any]]] = {}
-        for (kind, uid), fetcher in self.registry.items():
-            new_state.setdefault(kind, {})[uid] = fetcher.save_data()
-        return new_state
-
-
-async def run_for_distro(
+    def forget(self, dc: DistroConfig) -> None:
+        """
+        Drop the fetcher of a distro, so that the next get() creates it afresh
+        from the saved state. Fetchers look up the latest index just once, so
+        long-running processes need this to see later updates.
+        """
+        self.registry.pop(fetcher_key(dc), None)
+
+
+@dataclass
+class Package:
+    """A package which has been resolved for one or more distros"""
+
+    url: str
+    checksum: Checksum | None
+    signature: str | None
+    distros: list[DistroConfig]
+    size: int | None = None
+    # The predicted and actual seconds spent processing the package
+    cost: float = 0.0
+    elapsed: float = 0.0
+    # The start and end time of each stage the package has passed through
+    stages: dict[str, tuple[float, float]] = field(default_factory=dict)
+    # Set by the download stage
+    file: Path | None = None
+    sigfile: Path | None = None
+
+
+async def resolve_package(
     d: DistroConfig,
     fetcher: Fetcher,
     state: dict[str, Any],
-    save_dir: Path,
-    out_dir: Path,
-) -> tuple[DistroConfig, dict[str, Any]]:
-    workdir = save_dir / "distro" / d.unique_name
-
-    out = out_dir / d.unique_name / "config"
-    out.parent.mkdir(exist_ok=True, parents=True)
-
+) -> Package | None:
+    """Return the package to download for a distro, or None if unchanged"""
     previous_url = state.get("latest_url", "NONE")
     if d.do_update and await fetcher.is_updated():
-        if workdir.exists():
-            shutil.rmtree(workdir)
-        workdir.mkdir(parents=True)
         latest_url, maybe_csum = await fetcher.latest_version_url(d.package)
         if latest_url != previous_url:
-            async with extract_sem:
-                name = posixpath.basename(latest_url)
-                file = workdir / name
-                await download_file(latest_url, file, checksum=maybe_csum)
+            maybe_sig = await fetcher.signature_url(d.package)
+            size = await fetcher.package_size(d.package)
+            if size is None:
+                size = await content_length(latest_url)
+            return Package(latest_url, maybe_csum, maybe_sig, [d], size)
+    return None
+
+
+async def content_length(url: str) -> int | None:
+    """
+    Return the size of a package from a HEAD request, or None if unknown. The
+    size is only for scheduling, so a failed request is not an error.
+    """
+    try:
+        headers = await head_file(url)
+    except Exception as e:
+        print(f"warning: could not get the size of {url}: {e}")
+        return None
+    # A redirect's length is that of its own body, not of the package
+    if "Location" in headers or "Content-Length" not in headers:
+        return None
+    return int(headers["Content-Length"])
+
+
+def package_groups(distros: list[DistroConfig]) -> list[list[DistroConfig]]:
+    """
+    Group together distros whose configuration differs only by architecture
+
+    Fetchers may resolve each distro of a group to the same package, such as an
+    upstream kernel source tarball. Resolving the group together allows that
+    package to be downloaded, verified and extracted just once.
+    """
+    groups: dict[tuple[Any, ...], list[DistroConfig]] = {}
+    for d in distros:
+        groups.setdefault(astuple(replace(d, arch="")), []).append(d)
+    return list(groups.values())
+
+
+class Channel(Protocol[T]):
+    """The part of the asyncio.Queue interface which run_stage() uses"""
+
+    async def get(self) -> T | None:
+        """Return the next item, or None at the end"""
+
+    async def put(self, item: T | None) -> None:
+        """Add an item, or None to mark the end"""
+
+
+def shard_distros(
+    distros: list[DistroConfig], shard: int, count: int
+) -> list[DistroConfig]:
+    """
+    Return the distros of one shard out of count (numbered from 1)
+
+    Distros which share a fetcher or a package are kept on the same shard, so
+    that each index and package is still fetched once. These clusters are
+    assigned largest first to the shard with the fewest distros so far. The
+    split depends only on the list of distros, so every shard of a run
+    computes the same one.
+    """
+    # Union-find over the distros, joined by their fetchers and packages
+    parent = list(range(len(distros)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    first: dict[Any, int] = {}
+    for i, d in enumerate(distros):
+        for key in (fetcher_key(d), astuple(replace(d, arch=""))):
+            j = first.setdefault(key, i)
+            parent[find(i)] = find(j)
+
+    clusters: dict[int, list[DistroConfig]] = {}
+    for i, d in enumerate(distros):
+        clusters.setdefault(find(i), []).append(d)
+    ordered = sorted(
+        clusters.values(),
+        key=lambda c: (-len(c), min(d.unique_name for d in c)),
+    )
 
-                extractor = Extractor.get(d.extractor)
+    sizes = [0] * count
+    mine = []
+    for cluster in ordered:
+        target = sizes.index(min(sizes))
+        sizes[target] += len(cluster)
+        if target == shard - 1:
+            mine += cluster
+    return mine
+
+
+async def run_stage(
+    inbox: Channel[T],
+    workers: int,
+    work: Callable[[T], Awaitable[list[U]]],
+    outbox: Channel[U] | None = None,
+) -> None:
+    """
+    Run a pool of workers over a queue, until it yields None
+
+    Each item of work may produce any number of items for the outbox, and then
+    None is sent on to mark the end of this stage. Since the queues are
+    bounded, a slow stage holds back the stages before it.
+    """
+
+    async def worker() -> None:
+        while (item := await inbox.get()) is not None:
+            for result in await work(item):
+                assert outbox is not None
+                await outbox.put(result)
+        # Pass the end marker on to the other workers
+        await inbox.put(None)
 
-                maybe_sig = await fetcher.signature_url(d.package)
-                if maybe_sig:
-                    signame = posixpath.basename(maybe_sig)
-                    sigfile = workdir / signame
-                    await download_file(maybe_sig, sigfile)
-                    await extractor.verify_signature(file, sigfile, d)
+    async with asyncio.TaskGroup() as tg:
+        for _ in range(workers):
+            tg.create_task(worker())
+    if outbox is not None:
+        await outbox.put(None)
+
+
+class CostQueue:
+    """A bounded queue of packages, which hands out the costliest first"""
+
+    queue: asyncio.PriorityQueue[tuple[float, int, Package | None]]
+
+    def __init__(self, maxsize: int):
+        self.queue = asyncio.PriorityQueue(maxsize)
+        self.seq = itertools.count()
+
+    async def get(self) -> Package | None:
+        _, _, pkg = await self.queue.get()
+        return pkg
+
+    async def put(self, pkg: Package | None) -> None:
+        # The end marker sorts after every package
+        prio = float("inf") if pkg is None else -pkg.cost
+        await self.queue.put((prio, next(self.seq), pkg))
+
+
+class Admission:
+    """
+    A queue of packages, which hands out a package only once its estimated
+    footprint fits within the disk and memory budgets
+
+    Packages are admitted costliest first, except that a package which would
+    overflow a budget lets smaller ones go ahead of it: several
+    small jobs at once are better than one which runs the disk dry. A package
+    which exceeds a budget all by itself is admitted once nothing else runs.
+    """
+
+    def __init__(self, budgets: dict[str, int]):
+        self.budget = (budgets["disk"], budgets["memory"])
+        self.used = (0, 0)
+        self.pending: list[tuple[Package, tuple[int, int]]] = []
+        self.running: dict[str, tuple[int, int]] = {}
+        self.closed = False
+        self.changed = asyncio.Condition()
+
+    def footprint(self, pkg: Package) -> tuple[int, int]:
+        extractor = Extractor.get(pkg.distros[0].extractor)
+        size = pkg.size if pkg.size is not None else UNKNOWN_SIZE
+        return extractor.footprint(size, len(pkg.distros))
+
+    def fits(self, need: tuple[int, int]) -> bool:
+        return not self.running or all(
+            used + n <= budget
+            for used, n, budget in zip(self.used, need, self.budget)
+        )
+
+    async def put(self, pkg: Package | None) -> None:
+        async with self.changed:
+            if pkg is None:
+                self.closed = True
+            else:
+                self.pending.append((pkg, self.footprint(pkg)))
+                self.pending.sort(key=lambda item: -item[0].cost)
+            self.changed.notify_all()
+
+    async def get(self) -> Package | None:
+        async with self.changed:
+            while True:
+                for i, (pkg, need) in enumerate(self.pending):
+                    if self.fits(need):
+                        del self.pending[i]
+                        self.running[pkg.url] = need
+                        self.used = (
+                            self.used[0] + need[0],
+                            self.used[1] + need[1],
+                        )
+                        return pkg
+                if self.closed and not self.pending:
+                    return None
+                await self.changed.wait()
+
+    async def release(self, pkg: Package) -> None:
+        async with self.changed:
+            need = self.running.pop(pkg.url)
+            self.used = (self.used[0] - need[0], self.used[1] - need[1])
+            self.changed.notify_all()
+
+
+def extractor_rates(
+    distros: list[DistroConfig], distro_state: dict[str, Any]
+) -> dict[str, float]:
+    """Return the mean seconds per package byte of each extractor so far"""
+    totals: dict[str, tuple[float, int]] = {}
+    for d in distros:
+        state = distro_state.get(d.unique_name, {})
+        if state.get("size") and "duration" in state:
+            duration, size = totals.get(d.extractor, (0.0, 0))
+            totals[d.extractor] = (
+                duration + state["duration"],
+                size + state["size"],
+            )
+    return {kind: duration / size for kind, (duration, size) in totals.items()}
+
+
+def predict_makespan(costs: list[float], workers: int) -> float:
+    """Return the time to run the jobs longest first on a pool of workers"""
+    finish = [0.0] * max(workers, 1)
+    for cost in sorted(costs, reverse=True):
+        heapq.heappush(finish, heapq.heappop(finish) + cost)
+    return max(finish)
+
+
+class Pipeline:
+    """
+    Update the configs of a set of distros, in stages:
+
+      resolve -> download -> verify -> extract
+
+    Each stage has its own pool of workers, so that network-bound and CPU-bound
+    work overlap rather than holding each other's slots, and the stages are
+    connected by bounded queues, so that downloads cannot get far ahead of the
+    extraction which frees their disk space. Further, a package is only
+    admitted to the download stage while the estimated disk and memory
+    footprint of all the packages in flight stays within the budgets.
+
+    Packages are dispatched longest first, using the time which their distros
+    took on the previous run, or else an estimate from the package size, so
+    that a big package does not start last and hold up the end of the run.
+
+    Each config extracted is recorded in the history, if there is one.
+
+    The state of each distro is saved as soon as it completes. A distro which
+    fails is recorded in the state with its error, and the rest carry on
+    without it. The state of a fetcher is only advanced once all of its distros
+    have completed, so that the next run retries any distro which failed or
+    was interrupted, and skips those which are done.
+    """
+
+    def __init__(
+        self,
+        fetchers: FetcherFactory,
+        state: State,
+        save_dir: Path,
+        out_dir: Path,
+        jobs: dict[str, int],
+        budgets: dict[str, int],
+        history: History | None = None,
+    ):
+        self.fetchers = fetchers
+        self.state = state
+        self.history = history
+        # The state from the previous run
+        self.distro_state = dict(state.distros)
+        self.save_dir = save_dir
+        self.out_dir = out_dir
+        self.jobs = jobs
+        self.budgets = budgets
+        self.admission: Admission | None = None
+        self.rates: dict[str, float] = {}
+        # The distros of each fetcher which have yet to complete
+        self.pending: dict[tuple[str, str], set[str]] = {}
+        self.failed: dict[str, tuple[str, str]] = {}
+        self.done: list[Package] = []
+        self.started: float | None = None
+
+    def workdir(self, d: DistroConfig) -> Path:
+        return self.save_dir / "distro" / d.unique_name
+
+    def clear_workdir(self, d: DistroConfig) -> None:
+        workdir = self.workdir(d)
+        if workdir.exists():
+            shutil.rmtree(workdir)
 
-                print(f"Extract config of {d.unique_name}")
-                await extractor.extract_kconfig(file, out, d)
-    else:
-        latest_url = previous_url
-    if workdir.exists():
-        # Clear the distro's work directory to conserve space
-        shutil.rmtree(workdir)
-    return d, {"latest_url": latest_url}
+    def complete(self, d: DistroConfig, result: dict[str, Any]) -> None:
+        self.state.set_distro(d.unique_name, result)
+        key = fetcher_key(d)
+        self.pending[key].discard(d.unique_name)
+        if not self.pending[key] and key not in self.failed.values():
+            kind, uid = key
+            self.state.set_fetcher(kind, uid, self.fetchers.get(d).save_data())
+        self.state.save()
+
+    def fail(self, distros: list[DistroConfig], error: Exception) -> None:
+        names = ", ".join(d.unique_name for d in distros)
+        print(f"warning: failed to update {names}: {error!r}")
+        traceback.print_exception(error)
+        for d in distros:
+            state = dict(self.distro_state.get(d.unique_name, {}))
+            state["error"] = repr(error)
+            self.state.set_distro(d.unique_name, state)
+            self.failed[d.unique_name] = fetcher_key(d)
+        self.state.save()
+
+    @contextlib.asynccontextmanager
+    async def isolate(self, pkg: Package) -> AsyncIterator[None]:
+        """Record the failure of a stage against the distros of pkg"""
+        try:
+            yield
+        except Exception as e:
+            self.fail(pkg.distros, e)
+            self.clear_workdir(pkg.distros[0])
+            assert self.admission
+            await self.admission.release(pkg)
+
+    def predict(self, pkg: Package) -> float:
+        """Return the expected seconds to download, verify and extract pkg"""
+        durations = [
+            self.distro_state.get(d.unique_name, {}).get("duration")
+            for d in pkg.distros
+        ]
+        if all(duration is not None for duration in durations):
+            return float(max(durations))
+        size = pkg.size if pkg.size is not None else UNKNOWN_SIZE
+        rate = self.rates.get(pkg.distros[0].extractor, DEFAULT_RATE)
+        # Later targets of a package share most of the work of the first
+        return size * rate * (1 + (len(pkg.distros) - 1) / 4)
+
+    async def resolve(self, distros: list[DistroConfig]) -> list[Package]:
+        start = time.monotonic()
+        for d in distros:
+            self.clear_workdir(d)
+
+        resolved = await asyncio.gather(
+            *(
+                resolve_package(
+                    d,
+                    self.fetchers.get(d),
+                    self.distro_state.get(d.unique_name, {}),
+                )
+                for d in distros
+            ),
+            return_exceptions=True,
+        )
+
+        packages: dict[str, Package] = {}
+        for d, pkg in zip(distros, resolved):
+            if isinstance(pkg, Exception):
+                self.fail([d], pkg)
+            elif isinstance(pkg, BaseException):
+                raise pkg
+            elif pkg is None:
+                state = self.distro_state.get(d.unique_name, {})
+                result = {"latest_url": state.get("latest_url", "NONE")}
+                for key in HISTORY:
+                    if key in state:
+                        result[key] = state[key]
+                self.complete(d, result)
+            elif pkg.url in packages:
+                packages[pkg.url].distros.append(d)
+            else:
+                packages[pkg.url] = pkg
+        for pkg in packages.values():
+            pkg.cost = self.predict(pkg)
+            pkg.stages["resolve"] = (start, time.monotonic())
+        return list(packages.values())
+
+    async def download(self, pkg: Package) -> list[Package]:
+        start = time.monotonic()
+        if self.started is None:
+            self.started = start
+        async with self.isolate(pkg):
+            workdir = self.workdir(pkg.distros[0])
+            workdir.mkdir(parents=True, exist_ok=True)
+            pkg.file = workdir / posixpath.basename(pkg.url)
+            downloads = [
+                download_file(pkg.url, pkg.file, checksum=pkg.checksum)
+            ]
+            if pkg.signature:
+                pkg.sigfile = workdir / posixpath.basename(pkg.signature)
+                downloads.append(download_file(pkg.signature, pkg.sigfile))
+            await asyncio.gather(*downloads)
+            pkg.stages["download"] = (start, time.monotonic())
+            pkg.elapsed += time.monotonic() - start
+            return [pkg]
+        return []
+
+    async def verify(self, pkg: Package) -> list[Package]:
+        start = time.monotonic()
+        async with self.isolate(pkg):
+            if pkg.sigfile:
+                assert pkg.file
+                d = pkg.distros[0]
+                extractor = Extractor.get(d.extractor)
+                await extractor.verify_signature(pkg.file, pkg.sigfile, d)
+            pkg.stages["verify"] = (start, time.monotonic())
+            pkg.elapsed += time.monotonic() - start
+            return [pkg]
+        return []
+
+    async def extract(self, pkg: Package) -> list[None]:
+        start = time.monotonic()
+        async with self.isolate(pkg):
+            assert pkg.file
+            targets = []
+            for distro in pkg.distros:
+                out = self.out_dir / distro.unique_name / "config"
+                out.parent.mkdir(exist_ok=True, parents=True)
+                targets.append((out, distro))
+
+            names = ", ".join(distro.unique_name for distro in pkg.distros)
+            print(f"Extract config of {names}")
+            extractor = Extractor.get(pkg.distros[0].extractor)
+            try:
+                await extractor.extract_kconfigs(pkg.file, targets)
+            finally:
+                # Clear the distro's work directory to conserve space
+                self.clear_workdir(pkg.distros[0])
+            pkg.stages["extract"] = (start, time.monotonic())
+            pkg.elapsed += time.monotonic() - start
+            self.done.append(pkg)
+            for d in pkg.distros:
+                result = {
+                    "latest_url": pkg.url,
+                    "duration": round(pkg.elapsed, 1),
+                }
+                if pkg.size is not None:
+                    result["size"] = pkg.size
+                self.complete(d, result)
+            assert self.admission
+            await self.admission.release(pkg)
+            self.record_history(pkg.url, targets)
+        return []
+
+    def record_history(
+        self, url: str, targets: list[tuple[Path, DistroConfig]]
+    ) -> None:
+        """
+        Record the extracted configs in the history, if kept. This comes after
+        the distros are complete, as their configs are good whether or not the
+        history can take them.
+        """
+        if not self.history:
+            return
+        for out, d in targets:
+            try:
+                self.history.record_file(d.unique_name, url, out)
+            except Exception as e:
+                print(
+                    f"warning: failed to record {d.unique_name} in the "
+                    f"history: {e!r}"
+                )
+
+    def report(self) -> None:
+        """
+        Print the critical path of the run: the chain of stages, and the waits
+        between them, of the last package to finish
+        """
+        if not self.done or self.started is None:
+            return
+        last = max(self.done, key=lambda pkg: pkg.stages["extract"][1])
+        names = ", ".join(d.unique_name for d in last.distros)
+        steps = []
+        previous = None
+        for stage, (start, end) in last.stages.items():
+            if previous is not None:
+                steps.append(f"wait {start - previous:.1f}s")
+            steps.append(f"{stage} {end - start:.1f}s")
+            previous = end
+        print(f"Critical path ({names}): {' > '.join(steps)}")
+        print(
+            f"Work on it: predicted {last.cost:.1f}s, "
+            f"actual {last.elapsed:.1f}s"
+        )
+        makespan = predict_makespan(
+            [pkg.cost for pkg in self.done], self.jobs["extract"]
+        )
+        print(
+            f"Makespan of {len(self.done)} packages: predicted "
+            f"{makespan:.1f}s, actual {time.monotonic() - self.started:.1f}s"
+        )
+
+    async def run(self, distros: list[DistroConfig]) -> None:
+        """Run the pipeline, saving the new state of each distro"""
+        self.rates = extractor_rates(distros, self.distro_state)
+        for d in distros:
+            self.pending.setdefault(fetcher_key(d), set()).add(d.unique_name)
+        groups: asyncio.Queue[list[DistroConfig] | None] = asyncio.Queue()
+        for group in package_groups(distros):
+            groups.put_nowait(group)
+        groups.put_nowait(None)
+
+        # A package waits in a queue only until a worker of the next stage
+        # becomes free, except that the download stage also waits for room in
+        # the budgets.
+        self.admission = resolved = Admission(self.budgets)
+        downloaded = CostQueue(self.jobs["verify"])
+        verified = CostQueue(self.jobs["extract"])
+
+        try:
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(
+                    run_stage(
+                        groups, self.jobs["resolve"], self.resolve, resolved
+                    )
+                )
+                tg.create_task(
+                    run_stage(
+                        resolved,
+                        self.jobs["download"],
+                        self.download,
+                        downloaded,
+                    )
+                )
+                tg.create_task(
+                    run_stage(
+                        downloaded, self.jobs["verify"], self.verify, verified
+                    )
+                )
+                tg.create_task(
+                    run_stage(verified, self.jobs["extract"], self.extract)
+                )
+        finally:
+            for d in distros:
+                self.clear_workdir(d)
+        self.report()
+        if self.failed:
+            names = ", ".join(self.failed)
+            print(f"warning: {len(self.failed)} distros failed: {names}")
 
 
 def get_distros(
@@ -105,6 +660,8 @@ def get_distros(
         # handle non-string configs
         if "do_update" in args:
             args["do_update"] = cfg[sec].getboolean("do_update")
+        if "poll_interval" in args:
+            args["poll_interval"] = cfg[sec].getint("poll_interval")
         distros.append(DistroConfig(**args))
     return distros
 
@@ -113,10 +670,32 @@ def AbsPath(s: str) -> Path:
     return Path(s).absolute()
 
 
-async def main() -> None:
-    parser = argparse.ArgumentParser(
-        description="downloads and catalogs kernel configs"
-    )
+def Size(s: str) -> int:
+    m = re.fullmatch(r"(\d+)([KMGT]?)i?B?", s.strip(), re.IGNORECASE)
+    if not m:
+        raise argparse.ArgumentTypeError(f"invalid size: {s}")
+    shift = 10 * " KMGT".index(m.group(2).upper() or " ")
+    return int(m.group(1)) << shift
+
+
+def Shard(s: str) -> tuple[int, int]:
+    m = re.fullmatch(r"(\d+)/(\d+)", s)
+    if not m or not 1 <= int(m.group(1)) <= int(m.group(2)):
+        raise argparse.ArgumentTypeError(f"invalid shard: {s}")
+    return int(m.group(1)), int(m.group(2))
+
+
+def default_budgets(save_dir: Path) -> dict[str, int]:
+    """Leave a margin of the free disk space and available memory"""
+    save_dir.mkdir(parents=True, exist_ok=True)
+    disk = shutil.disk_usage(save_dir).free
+    memory = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    return {"disk": disk * 3 // 4, "memory": memory // 2}
+
+
+def argument_parser(description: str) -> argparse.ArgumentParser:
+    """Return a parser of the options for running the pipeline"""
+    parser = argparse.ArgumentParser(description=description)
     parser.add_argument(
         "config",
         help="configuration file",
@@ -127,6 +706,12 @@ async def main() -> None:
         type=AbsPath,
         help="JSON file which will hold state of last download",
     )
+    parser.add_argument(
+        "--history",
+        default=AbsPath("history.db"),
+        type=AbsPath,
+        help="SQLite database recording every config extracted",
+    )
     parser.add_argument(
         "--download-dir",
         default=Path.cwd() / "save",
@@ -147,58 +732,112 @@ async def main() -> None:
         help="Filter to only the given config.ini sections (fnmatch(3) patterns"
         "are accepted)",
     )
+    parser.add_argument(
+        "--resolve-jobs",
+        type=int,
+        default=16,
+        help="number of distro groups to check for updates concurrently",
+    )
+    parser.add_argument(
+        "--download-jobs",
+        type=int,
+        default=8,
+        help="number of packages to download concurrently",
+    )
+    parser.add_argument(
+        "--verify-jobs",
+        type=int,
+        default=multiprocessing.cpu_count(),
+        help="number of package signatures to verify concurrently",
+    )
+    parser.add_argument(
+        "--extract-jobs",
+        type=int,
+        default=multiprocessing.cpu_count() + 1,
+        help="number of packages to extract configs from concurrently",
+    )
+    parser.add_argument(
+        "--disk-budget",
+        type=Size,
+        help="disk space which packages in flight may use, such as 20G "
+        "(default: 3/4 of the free space in the download directory)",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=Size,
+        help="memory which packages in flight may use, such as 4G "
+        "(default: 1/2 of the available memory)",
+    )
 
-    args = parser.parse_args()
-    cfg = configparser.ConfigParser()
-    cfg.read(args.config)
-
-    if args.state.exists():
-        with args.state.open() as f:
-            state = json.load(f)
-    else:
-        state = {}
-
-    fetcher_state = state.get("fetchers", {})
-    distro_state = state.get("distros", {})
-
-    distros = get_distros(cfg, args.filter)
-    fetchers = FetcherFactory(fetcher_state, args.download_dir)
+    return parser
 
-    if args.filter:
-        new_fetcher_state = fetcher_state.copy()
-        new_distro_state = distro_state.copy()
-    else:
-        new_fetcher_state = {}
-        new_distro_state = {}
 
-    async with asyncio.TaskGroup() as tg:
-        tasks = []
-        for distro in distros:
-            fetcher = fetchers.get(distro)
-            state = distro_state.get(distro.unique_name, {})
-            fut = tg.create_task(
-                run_for_distro(
-                    distro, fetcher, state, args.download_dir, args.output_dir
-                )
-            )
-            fut.set_name(distro.unique_name)
-            tasks.append(fut)
+def pipeline_options(
+    args: argparse.Namespace,
+) -> tuple[dict[str, int], dict[str, int]]:
+    """Return the job counts and budgets of the pipeline from the options"""
+    jobs = {
+        "resolve": args.resolve_jobs,
+        "download": args.download_jobs,
+        "verify": args.verify_jobs,
+        "extract": args.extract_jobs,
+    }
+    budgets = default_budgets(args.download_dir)
+    if args.disk_budget is not None:
+        budgets["disk"] = args.disk_budget
+    if args.memory_budget is not None:
+        budgets["memory"] = args.memory_budget
+    return jobs, budgets
 
-        for fut in asyncio.as_completed(tasks):  # type: ignore
-            distro, state = await fut
-            new_distro_state[distro.unique_name] = state
 
-    new_fetcher_state.update(fetchers.save_state())
+async def main() -> None:
+    parser = argument_parser("downloads and catalogs kernel configs")
+    parser.add_argument(
+        "--shard",
+        type=Shard,
+        metavar="I/N",
+        help="only update shard I of N (numbered from 1), keeping distros "
+        "which share a fetcher together. The state file then holds just this "
+        "shard's state, for kconfigs.merge to combine.",
+    )
+    args = parser.parse_args()
+    cfg = configparser.ConfigParser()
+    cfg.read(args.config)
 
-    with args.state.open("wt") as f:
-        data = {
-            "fetchers": new_fetcher_state,
-            "distros": new_distro_state,
-        }
-        json.dump(data, f, sort_keys=True, indent=4)
-        f.write("\n")  # newline at end of file for the git hooks
+    state = State(args.state)
+    distros = get_distros(cfg, args.filter)
+    if args.shard:
+        distros = shard_distros(distros, *args.shard)
+    fetchers = FetcherFactory(state.fetchers, args.download_dir)
+    Extractor.savedir = args.download_dir / "extractor"
+
+    jobs, budgets = pipeline_options(args)
+    history = History(args.history)
+    pipeline = Pipeline(
+        fetchers,
+        state,
+        args.download_dir,
+        args.output_dir,
+        jobs,
+        budgets,
+        history,
+    )
+    await pipeline.run(distros)
+    history.close()
+
+    if args.shard or not args.filter:
+        # Forget about distros and fetchers which are no longer configured, or
+        # which belong to other shards
+        state.prune(
+            {d.unique_name for d in distros},
+            {fetcher_key(d) for d in distros},
+        )
+    state.save()
 
     await download_manager().session.close()
+    if pipeline.failed:
+        # The successes are saved above, but the run as a whole failed
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,278 @@
+# Copyright (c) 2024, Oracle and/or its affiliates.
+# Licensed under the terms of the GNU General Public License.
+"""
+The parsed configs of many distros, as a matrix of value codes
+
+Each row of the matrix is a symbol, and each column a distro. Each distinct
+value is stored once, in a dictionary ordered from the most common value, with
+code 0 reserved for null (not set), so that statistics and comparisons of the
+configs are vectorized operations on small integers.
+"""
+import json
+import os
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import numpy.typing as npt
+
+from kconfigs.config import ParsedKconfig
+from kconfigs.config import SymbolTable
+
+# The number of symbols to one-hot encode at a time, when comparing distros
+BLOCK_SYMBOLS = 512
+
+
+class ConfigMatrix:
+    def __init__(
+        self,
+        distros: list[str],
+        symbols: list[str],
+        values: list[str | None],
+        codes: npt.NDArray[Any],
+    ):
+        self.distros = distros
+        self.symbols = symbols
+        self.values = values
+        self.codes = codes
+
+    @classmethod
+    def from_parsed(
+        cls,
+        distros: list[str],
+        table: SymbolTable,
+        kconfigs: list[ParsedKconfig],
+    ) -> "ConfigMatrix":
+        """
+        Build the matrix of the configs of each distro, as parsed by
+        parse_kconfig_fast() into the table
+
+        Symbols are named without their CONFIG_ prefix, in the order of their
+        full names, so that the same configs always give the same matrix.
+        """
+        keys = sorted(range(len(table.symbols)), key=table.symbols.__getitem__)
+        rows = np.empty(len(keys), np.intp)
+        rows[keys] = np.arange(len(keys))
+
+        # Codes of the table, to begin with
+        codes = np.zeros((len(keys), len(kconfigs)), dtype=np.uint32)
+        for col, kconfig in enumerate(kconfigs):
+            idx = rows[np.frombuffer(kconfig.symbols, np.uint32)]
+            codes[idx, col] = np.frombuffer(kconfig.values, np.uint32)
+
+        counts = np.bincount(codes.ravel(), minlength=len(table.values))
+        others = [i for i in range(1, len(table.values)) if counts[i]]
+        order = [0] + sorted(
+            others, key=lambda i: (-counts[i], table.values[i])
+        )
+        remap = np.zeros(len(table.values), dtype=np.uint32)
+        remap[order] = np.arange(len(order))
+        width = np.min_scalar_type(len(order) - 1)
+        return cls(
+            distros,
+            [table.symbols[i].removeprefix("CONFIG_") for i in keys],
+            [table.values[i] for i in order],
+            remap[codes].astype(width),
+        )
+
+    @classmethod
+    def load(cls, directory: Path) -> "ConfigMatrix":
+        """Load a saved matrix, with its codes mapped into memory"""
+        with (directory / "matrix.json").open() as f:
+            meta = json.load(f)
+        codes = np.load(directory / "matrix.npy", mmap_mode="r")
+        if codes.shape != (len(meta["symbols"]), len(meta["distros"])):
+            raise Exception(f"The matrix in {directory} is inconsistent")
+        return cls(meta["distros"], meta["symbols"], meta["values"], codes)
+
+    def save(self, directory: Path) -> None:
+        """
+        Save the matrix into a directory: the codes, as matrix.npy, which load()
+        maps into memory rather than reading, and the names of the distros and
+        symbols, and the values, as matrix.json
+        """
+        directory.mkdir(parents=True, exist_ok=True)
+        meta = {
+            "distros": self.distros,
+            "symbols": self.symbols,
+            "values": self.values,
+        }
+        tmp = directory / "matrix.npy.tmp"
+        with tmp.open("wb") as f:
+            np.save(f, self.codes)
+        os.replace(tmp, directory / "matrix.npy")
+        tmp = directory / "matrix.json.tmp"
+        with tmp.open("w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, directory / "matrix.json")
+
+    def sorted(self) -> "ConfigMatrix":
+        """Return the matrix with its rows in the order of the symbol names"""
+        order = sorted(range(len(self.symbols)), key=self.symbols.__getitem__)
+        return ConfigMatrix(
+            self.distros,
+            [self.symbols[i] for i in order],
+            self.values,
+            self.codes[order],
+        )
+
+    def code(self, value: str) -> int | None:
+        try:
+            return self.values.index(value)
+        except ValueError:
+            return None
+
+    def tally(self, axis: int) -> dict[str, npt.NDArray[np.intp]]:
+        """
+        Count the symbols set to y, to m, unset, and set to another value: for
+        each distro with axis=0, or for each symbol with axis=1
+        """
+        counts = {}
+        for key, value in (("y", "y"), ("m", "m")):
+            code = self.code(value)
+            if code is None:
+                counts[key] = np.zeros(self.codes.shape[1 - axis], np.intp)
+            else:
+                counts[key] = np.count_nonzero(self.codes == code, axis=axis)
+        counts["unset"] = np.count_nonzero(self.codes == 0, axis=axis)
+        counts["other"] = (
+            self.codes.shape[axis] - counts["y"] - counts["m"] - counts["unset"]
+        )
+        return counts
+
+    def column(
+        self, distro: int, start: int = 0, stop: int | None = None
+    ) -> bytes:
+        """Return a distro's codes for a range of symbols, little-endian"""
+        col = self.codes[start:stop, distro]
+        return col.astype(col.dtype.newbyteorder("<")).tobytes()
+
+    def rows(self) -> dict[str, list[str | None]]:
+        """Return the list of values of each symbol, in the order of distros"""
+        return {
+            sym: [self.values[c] for c in row]
+            for sym, row in zip(self.symbols, self.codes.tolist())
+        }
+
+    def distances(self) -> npt.NDArray[np.float64]:
+        """
+        Return the distance between each pair of distros: the Jaccard distance
+        of their sets of symbol=value pairs, leaving out unset symbols
+
+        Rather than compare every pair of columns, a block of symbols at a time
+        is one-hot encoded, with a column for each distinct symbol=value pair,
+        and the counts of pairs in common come from a matrix product.
+        """
+        ndistros = self.codes.shape[1]
+        same = np.zeros((ndistros, ndistros))
+        nvalues = len(self.values)
+        for start in range(0, len(self.symbols), BLOCK_SYMBOLS):
+            block = self.codes[start : start + BLOCK_SYMBOLS].astype(np.int64)
+            isset = block != 0
+            rows, cols = np.nonzero(isset)
+            pairs = rows * nvalues + block[rows, cols]
+            uniq, pair_cols = np.unique(pairs, return_inverse=True)
+            onehot = np.zeros((ndistros, len(uniq)), np.float32)
+            onehot[cols, pair_cols] = 1
+            same += onehot @ onehot.T
+        nset = np.count_nonzero(self.codes, axis=0)
+        union = nset[:, np.newaxis] + nset[np.newaxis, :] - same
+        with np.errstate(invalid="ignore", divide="ignore"):
+            dist = np.where(union > 0, (union - same) / union, 0.0)
+        np.fill_diagonal(dist, 0.0)
+        return dist
+
+
+def neighbours(
+    dist: npt.NDArray[np.float64], k: int
+) -> list[list[tuple[int, float]]]:
+    """Return the k nearest other distros to each, with their distances"""
+    n = len(dist)
+    k = min(k, n - 1)
+    if k <= 0:
+        return [[] for _ in range(n)]
+    d = dist.copy()
+    np.fill_diagonal(d, np.inf)
+    nearest = np.argpartition(d, k - 1, axis=1)[:, :k]
+    result = []
+    for i, idx in enumerate(nearest):
+        idx = idx[np.lexsort((idx, d[i, idx]))]
+        result.append([(int(j), float(d[i, j])) for j in idx])
+    return result
+
+
+def linkage(
+    dist: npt.NDArray[np.float64],
+) -> list[tuple[int, int, float, int]]:
+    """
+    Cluster the distros hierarchically, by average linkage (UPGMA)
+
+    The result is in the form used by scipy: each merge joins two clusters at a
+    distance, giving a cluster of the given size. Clusters below n are single
+    distros, and merge i makes cluster n + i. The nearest-neighbour chain
+    algorithm takes O(n^2) time, rather than O(n^3) for the naive one.
+    """
+    n = len(dist)
+    d = dist.astype(np.float64, copy=True)
+    np.fill_diagonal(d, np.inf)
+    size = np.ones(n)
+    active = list(range(n))
+    merges: list[tuple[int, int, float]] = []
+    chain: list[int] = []
+    while len(merges) < n - 1:
+        if not chain:
+            chain.append(active[0])
+        a = chain[-1]
+        b = int(np.argmin(d[a]))
+        # Prefer the previous link on a tie, or the chain could cycle
+        if len(chain) > 1 and d[a, chain[-2]] <= d[a, b]:
+            b = chain[-2]
+        if len(chain) > 1 and b == chain[-2]:
+            del chain[-2:]
+            merges.append((a, b, float(d[a, b])))
+            # The merged cluster takes the place of a
+            merged = (size[a] * d[a] + size[b] * d[b]) / (size[a] + size[b])
+            d[a, :] = merged
+            d[:, a] = merged
+            d[b, :] = np.inf
+            d[:, b] = np.inf
+            d[a, a] = np.inf
+            size[a] += size[b]
+            active.remove(b)
+        else:
+            chain.append(b)
+
+    # The chain finds merges out of order, so sort them and name the clusters
+    merges.sort(key=lambda m: m[2])
+    parent = list(range(2 * n - 1))
+    count = [1] * (2 * n - 1)
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    result = []
+    for i, (a, b, height) in enumerate(merges):
+        x, y = sorted((find(a), find(b)))
+        parent[x] = parent[y] = n + i
+        count[n + i] = count[x] + count[y]
+        result.append((x, y, height, count[n + i]))
+    return result
+
+
+def leaf_order(n: int, merges: list[tuple[int, int, float, int]]) -> list[int]:
+    """Return the distros in the order of the leaves of the dendrogram"""
+    if not merges:
+        return list(range(n))
+    order = []
+    stack = [n + len(merges) - 1]
+    while stack:
+        i = stack.pop()
+        if i < n:
+            order.append(i)
+        else:
+            a, b, _, _ = merges[i - n]
+            stack += [b, a]
+    return order
@@ -0,0 +1,105 @@
+# Copyright (c) 2024, Oracle and/or its affiliates.
+# Licensed under the terms of the GNU General Public License.
+import argparse
+import shutil
+from configparser import ConfigParser
+from pathlib import Path
+
+from kconfigs.history import History
+from kconfigs.main import fetcher_key
+from kconfigs.main import get_distros
+from kconfigs.state import State
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Combine the results of a sharded kconfigs.main run"
+    )
+    parser.add_argument(
+        "config",
+        help="configuration file",
+        type=Path,
+    )
+    parser.add_argument(
+        "shards",
+        nargs="+",
+        type=Path,
+        help="directories of each shard, holding its state.json, out/ and "
+        "history.db",
+    )
+    parser.add_argument(
+        "--state",
+        default=Path.cwd() / "state.json",
+        type=Path,
+        help="JSON state file to merge the shards into",
+    )
+    parser.add_argument(
+        "--output-dir",
+        default=Path.cwd() / "out",
+        type=Path,
+        help="directory of configs to merge the shards into",
+    )
+    parser.add_argument(
+        "--history",
+        default=Path.cwd() / "history.db",
+        type=Path,
+        help="history database to merge the shards' histories into",
+    )
+
+    args = parser.parse_args()
+
+    cfg = ConfigParser()
+    cfg.read(args.config)
+    distros = get_distros(cfg, [])
+
+    state = State(args.state)
+    history = History(args.history)
+    fetcher_owner: dict[tuple[str, str], Path] = {}
+    distro_owner: dict[str, Path] = {}
+    for shard in args.shards:
+        shard_state = State(shard / "state.json")
+        for kind, states in shard_state.fetchers.items():
+            for uid, fetcher_state in states.items():
+                if (kind, uid) in fetcher_owner:
+                    other = fetcher_owner[kind, uid]
+                    raise Exception(
+                        f"Fetcher {uid} is in both {other} and {shard}"
+                    )
+                fetcher_owner[kind, uid] = shard
+                state.set_fetcher(kind, uid, fetcher_state)
+        for name, distro_state in shard_state.distros.items():
+            if name in distro_owner:
+                other = distro_owner[name]
+                raise Exception(
+                    f'Distro "{name}" is in both {other} and {shard}'
+                )
+            distro_owner[name] = shard
+            state.set_distro(name, distro_state)
+            # A distro which never succeeded has no config to copy
+            src = shard / "out" / name
+            dst = args.output_dir / name
+            if src.is_dir():
+                if dst.exists():
+                    shutil.rmtree(dst)
+                shutil.copytree(src, dst)
+        shard_history = shard / "history.db"
+        if shard_history.exists():
+            shard_db = History(shard_history)
+            added = history.merge(shard_db)
+            shard_db.close()
+            print(f"Merged {added} snapshots from {shard_history}")
+
+    for d in distros:
+        if d.unique_name not in distro_owner:
+            print(f'warning: no shard has state for "{d.unique_name}"')
+
+    state.prune(
+        {d.unique_name for d in distros},
+        {fetcher_key(d) for d in distros},
+    )
+    state.save()
+    history.close()
+
+
+if __name__ == "__main__":
+    main()
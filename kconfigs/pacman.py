@@ -37,6 +37,7 @@ class PacmanFetcher(Fetcher):
         self.__last_modified: None | str = saved_state.get("last_modified")
         self.__latest_modified: None | str = None
         self.__latest_url: None | str = None
+        self.__latest_size: None | int = None
         self.index = dc.index
         self.arch = dc.arch
         assert dc.repo is not None
@@ -74,12 +75,17 @@ class PacmanFetcher(Fetcher):
             checksum = ("sha256", desc["SHA256SUM"])
             url = posixpath.join(self.index, desc["FILENAME"])
             self.__latest_url = url
+            if "CSIZE" in desc:
+                self.__latest_size = int(desc["CSIZE"])
             return (url, checksum)
 
     async def signature_url(self, _: str) -> str | None:
         assert self.__latest_url is not None
         return self.__latest_url + ".sig"
 
+    async def package_size(self, _: str) -> int | None:
+        return self.__latest_size
+
 
 class PacmanExtractor(Extractor):
     async def extract_kconfig(
@@ -0,0 +1,148 @@
+# Copyright (c) 2024, Oracle and/or its affiliates.
+# Licensed under the terms of the GNU General Public License.
+"""
+Query the configs of all distros, from the index which the analyzer writes
+
+The index is the matrix of value codes (see kconfigs.matrix), with a row per
+symbol in sorted order, saved so that it is mapped into memory rather than read.
+A symbol's row is its inverted index: the value of the symbol in each distro,
+from which the distros with a given value are one vectorized comparison away.
+Nothing is parsed but the names of the symbols, distros and values.
+
+    # Which distros set CONFIG_BPF_LSM=y?
+    python -m kconfigs.query CONFIG_BPF_LSM=y
+
+    # Which symbols matching *KASAN* differ between these distros?
+    python -m kconfigs.query --differ '*KASAN*' \\
+        --distro 'Oracle Linux 9 (UEK*' \\
+        --distro 'Oracle Linux 9 (Red Hat Compatible) x86_64'
+"""
+import argparse
+import re
+from fnmatch import fnmatchcase
+from pathlib import Path
+
+import numpy as np
+
+from kconfigs.matrix import ConfigMatrix
+
+
+class Index:
+    def __init__(self, directory: Path):
+        self.matrix = ConfigMatrix.load(directory)
+        self.rows = {sym: i for i, sym in enumerate(self.matrix.symbols)}
+        self.codes = {val: i for i, val in enumerate(self.matrix.values)}
+
+    def symbols(self, pattern: str, regex: bool = False) -> list[str]:
+        """
+        Return the symbols matching a glob pattern, or a regular expression
+        which need only match part of the name. The CONFIG_ prefix is optional.
+        """
+        if regex:
+            rx = re.compile(pattern.replace("CONFIG_", "", 1))
+            return [sym for sym in self.matrix.symbols if rx.search(sym)]
+        pattern = pattern.removeprefix("CONFIG_")
+        if pattern in self.rows:
+            return [pattern]
+        return [sym for sym in self.matrix.symbols if fnmatchcase(sym, pattern)]
+
+    def distros(self, patterns: list[str] | None = None) -> list[int]:
+        """Return the indexes of the distros matching any of the patterns"""
+        return [
+            i
+            for i, name in enumerate(self.matrix.distros)
+            if not patterns or any(fnmatchcase(name, p) for p in patterns)
+        ]
+
+    def values(
+        self, symbol: str, distros: list[int] | None = None
+    ) -> dict[str, str | None]:
+        """Return the value of a symbol in each distro (None if unset)"""
+        row = self.matrix.codes[self.rows[symbol.removeprefix("CONFIG_")]]
+        if distros is None:
+            distros = list(range(len(row)))
+        return {
+            self.matrix.distros[i]: self.matrix.values[row[i]] for i in distros
+        }
+
+    def having(self, symbol: str, value: str | None) -> list[str]:
+        """Return the distros which set a symbol to a value (None: unset)"""
+        code = self.codes.get(value)
+        row = self.rows.get(symbol.removeprefix("CONFIG_"))
+        if code is None or row is None:
+            return []
+        found = np.flatnonzero(self.matrix.codes[row] == code)
+        return [self.matrix.distros[i] for i in found]
+
+    def differing(self, symbols: list[str], distros: list[int]) -> list[str]:
+        """Return those of the symbols which differ between the distros"""
+        if not symbols or not distros:
+            return []
+        rows = [self.rows[sym] for sym in symbols]
+        codes = self.matrix.codes[np.ix_(rows, distros)]
+        differ = (codes != codes[:, :1]).any(axis=1)
+        return [sym for sym, d in zip(symbols, differ) if d]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Query the kernel configs of all distros"
+    )
+    parser.add_argument(
+        "queries",
+        nargs="+",
+        metavar="QUERY",
+        help="SYMBOL=VALUE, to list the distros which set SYMBOL to VALUE "
+        "(where n means unset), or a pattern of symbols, to show their values",
+    )
+    parser.add_argument(
+        "--index-dir",
+        type=Path,
+        default=Path.cwd() / "out/index",
+        help="directory of the index written by kconfigs.analyzer",
+    )
+    parser.add_argument(
+        "--distro",
+        "-d",
+        action="append",
+        default=[],
+        help="only show distros matching this pattern (may be repeated)",
+    )
+    parser.add_argument(
+        "--regex",
+        "-E",
+        action="store_true",
+        help="patterns of symbols are regular expressions, rather than globs",
+    )
+    parser.add_argument(
+        "--differ",
+        action="store_true",
+        help="only show symbols whose values differ between the distros",
+    )
+    args = parser.parse_args()
+
+    index = Index(args.index_dir)
+    distros = index.distros(args.distro)
+    names = [index.matrix.distros[i] for i in distros]
+    for query in args.queries:
+        if "=" in query:
+            symbol, value = query.split("=", 1)
+            wanted = set(names)
+            for name in index.having(symbol, None if value == "n" else value):
+                if name in wanted:
+                    print(name)
+            continue
+        symbols = index.symbols(query, args.regex)
+        if args.differ:
+            symbols = index.differing(symbols, distros)
+        print("\t".join(["symbol"] + names))
+        for sym in symbols:
+            values = index.values(sym, distros).values()
+            cells = ["n" if val is None else val for val in values]
+            # UTS_RELEASE is not a real symbol, but the kernel release
+            name = sym if sym == "UTS_RELEASE" else f"CONFIG_{sym}"
+            print("\t".join([name] + cells))
+
+
+if __name__ == "__main__":
+    main()
@@ -18,17 +18,22 @@ from typing import TypeVar
 import aiosqlite
 from aiofiles.tempfile import TemporaryDirectory
 
+from kconfigs.decompress import fetch_cost
+from kconfigs.decompress import maybe_decompress
 from kconfigs.extractor import Extractor
 from kconfigs.fetcher import Checksum
 from kconfigs.fetcher import DistroConfig
 from kconfigs.fetcher import Fetcher
+from kconfigs.util import add_mirrors
 from kconfigs.util import check_call
 from kconfigs.util import download_file
 from kconfigs.util import download_file_mem_verified
-from kconfigs.util import maybe_decompress
 
 REPODATA = "repodata/repomd.xml"
 GROUPRE = re.compile("([0-9]+|[a-zA-Z]+)")
+# Rough seconds per byte to parse the XML metadata, which is parsed in full
+# for each package looked up, where the sqlite metadata needs no parsing
+XML_PARSE_RATE = 1 / (20 << 20)
 
 
 T = TypeVar("T", str, int)
@@ -40,6 +45,7 @@ class PkgMeta(NamedTuple):
     href: str
     checksum: str
     checksum_type: str
+    size: int | None
 
 
 def samekindcmp(s1: T, s2: T) -> int:
@@ -95,9 +101,11 @@ class RpmFetcher(Fetcher):
         self.__latest_db: None | str = None
         self.__latest_checksum: None | tuple[str, str] = None
         self.__latest_db_path: None | Path = None
+        self.__sizes: dict[str, int | None] = {}
         self.__mutex = asyncio.Lock()
         self.index = dc.index
         self.savedir = savedir
+        add_mirrors(dc.index, dc.mirrors, REPODATA)
         assert dc.key
         self.key = dc.key
 
@@ -114,15 +122,31 @@ class RpmFetcher(Fetcher):
             yum_base, self.key, https_ok=True
         )
         tree = ET.fromstring(data.decode("utf-8"))
-        # prefer primary_db because it's sqlite, which is faster to query
-        primary_db_list = tree.findall(".//{*}data[@type='primary_db']")
-        if not primary_db_list:
-            # fall back to XML where necessary
-            primary_db_list = tree.findall(".//{*}data[@type='primary']")
-        primary_db_data = primary_db_list[0]
-        location = primary_db_data.findall("{*}location")[0]
+        variants = []
+        for kind in ("primary_db", "primary"):
+            for elem in tree.findall(f".//{{*}}data[@type='{kind}']"):
+                href = elem.findall("{*}location")[0].attrib["href"]
+                size = elem.findtext("{*}size")
+                open_size = elem.findtext("{*}open-size")
+                if size is None:
+                    cost = float("inf")
+                else:
+                    cost = fetch_cost(
+                        href, int(size), int(open_size) if open_size else None
+                    )
+                    if kind == "primary":
+                        # sqlite is queried in place, but the XML is parsed
+                        cost += int(open_size or size) * XML_PARSE_RATE
+                variants.append((cost, elem, href))
+        if not variants:
+            raise Exception(f"No primary metadata in {yum_base}")
+        # The first listed wins ties, and sqlite is listed first
+        cost, primary_db_data, href = min(variants, key=lambda v: v[0])
+        print(
+            f"Metadata for {self.index}: {posixpath.basename(href)} "
+            f"(estimated {cost:.2f}s, of {len(variants)} variants)"
+        )
         checksum = primary_db_data.findall("{*}checksum")[0]
-        href = location.attrib["href"]
         if not href.startswith("http:") or href.startswith("https:"):
             href = posixpath.join(self.index, href)
         self.__latest_db = href
@@ -152,7 +176,9 @@ class RpmFetcher(Fetcher):
         async with aiosqlite.connect(self.__latest_db_path) as conn:
             result = await conn.execute(
                 """
-                SELECT version, release, location_href, pkgId, checksum_type FROM packages
+                SELECT version, release, location_href, pkgId, checksum_type,
+                       size_package
+                FROM packages
                 WHERE name=? AND location_href NOT LIKE '%.src.rpm';
                 """,
                 (pkg,),
@@ -170,6 +196,7 @@ class RpmFetcher(Fetcher):
             ver_elem = pkg_elem.find("{*}version")
             csum_elem = pkg_elem.find("{*}checksum")
             loc_elem = pkg_elem.find("{*}location")
+            size_elem = pkg_elem.find("{*}size")
             assert (
                 ver_elem is not None
                 and csum_elem is not None
@@ -182,6 +209,11 @@ class RpmFetcher(Fetcher):
                     loc_elem.attrib["href"],
                     csum_elem.text or "",  # satisfy mypy here :/
                     csum_elem.attrib["type"],
+                    (
+                        int(size_elem.attrib["package"])
+                        if size_elem is not None
+                        else None
+                    ),
                 )
             )
         return res
@@ -207,10 +239,14 @@ class RpmFetcher(Fetcher):
         href = rows[-1].href
         csum = rows[-1].checksum
         csum_type = rows[-1].checksum_type
+        self.__sizes[pkg] = rows[-1].size
         if not href.startswith("http:") or href.startswith("https:"):
             href = posixpath.join(self.index, href)
         return (href, (csum_type, csum))
 
+    async def package_size(self, pkg: str) -> int | None:
+        return self.__sizes.get(pkg)
+
 
 async def extract_rpm_file(
     rpm: Path,
@@ -278,6 +314,10 @@ async def verify_rpm(rpm: Path, key: str) -> None:
 
 
 class RpmExtractor(Extractor):
+    def footprint(self, size: int, targets: int) -> tuple[int, int]:
+        # Only the config file is written out of the cpio stream
+        return size + (1 << 20), 64 << 20
+
     async def extract_kconfig(
         self, package: Path, output: Path, dc: DistroConfig
     ) -> None:
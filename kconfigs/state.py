@@ -0,0 +1,62 @@
+# Copyright (c) 2024, Oracle and/or its affiliates.
+# Licensed under the terms of the GNU General Public License.
+import json
+import os
+from pathlib import Path
+from typing import Any
+
+
+class State:
+    """
+    The state of the fetchers and distros, as stored in ``state.json``
+
+    The state is saved each time a distro completes, rather than once at the
+    end of the run, so that an interrupted run loses no finished work. Each save
+    writes a new file and renames it over the old one, so a crash leaves either
+    the previous or the next state behind, never a partial one.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        data: dict[str, Any] = {}
+        if path.exists():
+            with path.open() as f:
+                data = json.load(f)
+        self.fetchers: dict[str, dict[str, Any]] = data.get("fetchers", {})
+        self.distros: dict[str, Any] = data.get("distros", {})
+
+    def set_fetcher(self, kind: str, uid: str, state: dict[str, Any]) -> None:
+        self.fetchers.setdefault(kind, {})[uid] = state
+
+    def set_distro(self, name: str, state: dict[str, Any]) -> None:
+        self.distros[name] = state
+
+    def prune(self, distros: set[str], fetchers: set[tuple[str, str]]) -> None:
+        """Drop the state of any distro or fetcher which is not listed"""
+        self.distros = {
+            name: state
+            for name, state in self.distros.items()
+            if name in distros
+        }
+        self.fetchers = {
+            kind: {
+                uid: state
+                for uid, state in states.items()
+                if (kind, uid) in fetchers
+            }
+            for kind, states in self.fetchers.items()
+        }
+        self.fetchers = {k: v for k, v in self.fetchers.items() if v}
+
+    def save(self) -> None:
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with tmp.open("wt") as f:
+            data = {
+                "fetchers": self.fetchers,
+                "distros": self.distros,
+            }
+            json.dump(data, f, sort_keys=True, indent=4)
+            f.write("\n")  # newline at end of file for the git hooks
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
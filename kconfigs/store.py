@@ -0,0 +1,284 @@
+# Copyright (c) 2024, Oracle and/or its affiliates.
+# Licensed under the terms of the GNU General Public License.
+"""
+A compact store of the configs in the output directory
+
+The configs of different distros are mostly the same, and many are identical,
+so rather than keep a full copy of each, the store keeps each distinct config
+once, named by its SHA-256, in one of two ways:
+
+zstd
+  Compressed by zstd, with a dictionary trained on all the configs, so that
+  the parts common to all of them cost next to nothing in each one.
+delta
+  As the lines which differ from a base config, which is kept in full: the one
+  whose lines are the most common across all the configs. The deltas are
+  plain text, which git packs well.
+
+The dictionary, or the base, is kept from one pack to the next, so that the
+objects of unchanged configs stay the same. A manifest maps each distro to its
+config's object. Plain files are written back with "materialize":
+
+    python -m kconfigs.store pack --input-dir out --store-dir store
+    python -m kconfigs.store materialize --store-dir store --output-dir out
+"""
+import argparse
+import difflib
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+from collections import Counter
+from pathlib import Path
+from typing import Any
+
+METHODS = ("zstd", "delta")
+# The largest dictionary to train, which zstd suggests be about 100 times
+# smaller than the samples in total
+MAX_DICTIONARY = 112640
+
+
+def sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class Store:
+    def __init__(self, root: Path):
+        self.root = root
+        self.objects = root / "objects"
+        self.manifest_path = root / "manifest.json"
+        self.manifest: dict[str, Any] = {"method": None, "distros": {}}
+        if self.manifest_path.exists():
+            with self.manifest_path.open() as f:
+                self.manifest = json.load(f)
+
+    def object_path(self, digest: str, suffix: str = "") -> Path:
+        return self.objects / digest[:2] / (digest[2:] + suffix)
+
+    def config_path(self, digest: str) -> Path:
+        """
+        Return the path of a config's object. It names the dictionary or base
+        which the config is encoded against, so that the objects of a new one
+        never overwrite those which the saved manifest still refers to.
+        """
+        method = self.manifest["method"]
+        ref = self.manifest.get("dictionary" if method == "zstd" else "base")
+        tag = f".{ref[:16]}" if ref else ""
+        return self.object_path(
+            digest, tag + (".zst" if method == "zstd" else ".delta")
+        )
+
+    def write_object(self, path: Path, data: bytes) -> None:
+        if path.exists():
+            return
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+
+    def save(self) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp = self.manifest_path.with_name("manifest.json.tmp")
+        with tmp.open("w") as f:
+            json.dump(self.manifest, f, sort_keys=True, indent=4)
+            f.write("\n")
+        os.replace(tmp, self.manifest_path)
+
+    def zstd(self, args: list[str], data: bytes) -> bytes:
+        cmd = ["zstd", "-q", "-c"] + args
+        dictionary = self.manifest.get("dictionary")
+        if dictionary:
+            cmd += ["-D", str(self.object_path(dictionary))]
+        proc = subprocess.run(cmd, input=data, capture_output=True)
+        if proc.returncode != 0:
+            raise Exception(f"zstd failed: {proc.stderr.decode().strip()}")
+        return proc.stdout
+
+    def train(self, configs: list[bytes]) -> None:
+        """Train the dictionary which the configs are compressed with"""
+        with tempfile.TemporaryDirectory() as tmp:
+            samples = []
+            for i, data in enumerate(configs):
+                sample = Path(tmp) / str(i)
+                sample.write_bytes(data)
+                samples.append(str(sample))
+            output = Path(tmp) / "dictionary"
+            proc = subprocess.run(
+                ["zstd", "-q", "--train", *samples, "-o", str(output)]
+                + [f"--maxdict={MAX_DICTIONARY}"],
+                capture_output=True,
+            )
+            if proc.returncode != 0:
+                # Too few samples, most likely: do without
+                print(f"warning: no dictionary: {proc.stderr.decode().strip()}")
+                self.manifest["dictionary"] = None
+                return
+            data = output.read_bytes()
+        self.manifest["dictionary"] = sha256(data)
+        self.write_object(self.object_path(sha256(data)), data)
+
+    def choose_base(self, configs: list[bytes]) -> None:
+        """Keep the config whose lines are the most common as the base"""
+        counts: Counter[bytes] = Counter()
+        for data in configs:
+            counts.update(set(data.splitlines()))
+
+        def score(data: bytes) -> float:
+            lines = data.splitlines()
+            return sum(counts[line] for line in lines) / max(len(lines), 1)
+
+        base = max(configs, key=score)
+        self.manifest["base"] = sha256(base)
+        self.write_object(self.object_path(sha256(base)), base)
+
+    def delta(self, data: bytes) -> bytes:
+        """Encode a config as the operations which turn the base into it"""
+        base_path = self.object_path(self.manifest["base"])
+        base = base_path.read_bytes().splitlines(keepends=True)
+        lines = data.splitlines(keepends=True)
+        matcher = difflib.SequenceMatcher(None, base, lines, autojunk=False)
+        ops: list[Any] = []
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag == "equal":
+                ops.append([i1, i2])
+            elif j2 > j1:
+                # latin-1 maps every byte to a character and back
+                ops.append([line.decode("latin-1") for line in lines[j1:j2]])
+        return json.dumps(ops, indent=0).encode()
+
+    def undelta(self, delta: bytes) -> bytes:
+        base_path = self.object_path(self.manifest["base"])
+        base = base_path.read_bytes().splitlines(keepends=True)
+        out = []
+        for op in json.loads(delta):
+            if isinstance(op[0], int):
+                out += base[op[0] : op[1]]
+            else:
+                out += [line.encode("latin-1") for line in op]
+        return b"".join(out)
+
+    def pack(
+        self, configs: dict[str, bytes], method: str, retrain: bool
+    ) -> None:
+        """
+        Store the config of each distro, replacing the manifest. The dictionary
+        or the base is only chosen again if the method changed, or retrain is
+        set. The old objects are only removed once the new manifest is saved,
+        so a failure leaves the store as it was.
+        """
+        if not configs:
+            raise Exception("No configs to pack")
+        if method != self.manifest.get("method") or retrain:
+            self.manifest = {"method": method, "distros": {}}
+            if method == "zstd":
+                self.train(list(configs.values()))
+            else:
+                self.choose_base(list(configs.values()))
+
+        distros = {}
+        for name, data in configs.items():
+            digest = sha256(data)
+            path = self.config_path(digest)
+            if not path.exists():
+                if method == "zstd":
+                    encoded = self.zstd(["-19"], data)
+                else:
+                    encoded = self.delta(data)
+                self.write_object(path, encoded)
+            distros[name] = digest
+        self.manifest["distros"] = distros
+        self.save()
+        self.collect()
+
+    def collect(self) -> None:
+        """Remove the objects which nothing refers to"""
+        keep = {self.config_path(d) for d in self.manifest["distros"].values()}
+        for key in ("dictionary", "base"):
+            if self.manifest.get(key):
+                keep.add(self.object_path(self.manifest[key]))
+        for path in self.objects.glob("*/*"):
+            if path not in keep:
+                path.unlink()
+
+    def read(self, name: str) -> bytes:
+        """Return the config of a distro"""
+        digest = self.manifest["distros"].get(name)
+        if digest is None:
+            raise Exception(f'Distro "{name}" is not in the store')
+        encoded = self.config_path(digest).read_bytes()
+        if self.manifest["method"] == "zstd":
+            data = self.zstd(["-d"], encoded)
+        else:
+            data = self.undelta(encoded)
+        if sha256(data) != digest:
+            raise Exception(f'The stored config of "{name}" is corrupt')
+        return data
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Pack configs into a compact store, or write them back"
+    )
+    parser.add_argument(
+        "action",
+        choices=("pack", "materialize"),
+        help="pack the configs of the input directory into the store, or "
+        "materialize the stored configs as files in the output directory",
+    )
+    parser.add_argument(
+        "--store-dir",
+        type=Path,
+        default=Path.cwd() / "store",
+        help="directory of the store",
+    )
+    parser.add_argument(
+        "--input-dir",
+        type=Path,
+        default=Path.cwd() / "out",
+        help="directory of configs to pack",
+    )
+    parser.add_argument(
+        "--output-dir",
+        type=Path,
+        default=Path.cwd() / "out",
+        help="directory to materialize configs in",
+    )
+    parser.add_argument(
+        "--method",
+        choices=METHODS,
+        default="zstd",
+        help="store configs compressed with a shared zstd dictionary, or as "
+        "deltas against a base config",
+    )
+    parser.add_argument(
+        "--retrain",
+        action="store_true",
+        help="train the dictionary, or choose the base, again",
+    )
+    parser.add_argument(
+        "distros",
+        nargs="*",
+        help="only materialize these distros",
+    )
+    args = parser.parse_intermixed_args()
+
+    store = Store(args.store_dir)
+    if args.action == "pack":
+        configs = {
+            path.parent.name: path.read_bytes()
+            for path in sorted(args.input_dir.glob("*/config"))
+        }
+        store.pack(configs, args.method, args.retrain)
+        size = sum(p.stat().st_size for p in args.store_dir.rglob("*"))
+        plain = sum(len(data) for data in configs.values())
+        print(f"Packed {len(configs)} configs of {plain} bytes into {size}")
+    else:
+        for name in args.distros or store.manifest["distros"]:
+            out = args.output_dir / name / "config"
+            out.parent.mkdir(parents=True, exist_ok=True)
+            out.write_bytes(store.read(name))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,159 @@
 # Copyright (c) 2024, Oracle and/or its affiliates.
 # Licensed under the terms of the GNU General Public License.
+import asyncio
+import lzma
 import os
 import posixpath
 import re
 import shutil
+import tempfile
 import xml.etree.ElementTree as ET
 from asyncio.subprocess import DEVNULL
+from asyncio.subprocess import PIPE
 from dataclasses import dataclass
+from fnmatch import fnmatchcase
 from pathlib import Path
 from typing import Any
 
 from aiofiles.tempfile import TemporaryDirectory
+from aiohttp import ClientResponseError
 
+from kconfigs.decompress import compression
+from kconfigs.decompress import decompress_command
 from kconfigs.extractor import Extractor
 from kconfigs.fetcher import Checksum
 from kconfigs.fetcher import DistroConfig
 from kconfigs.fetcher import Fetcher
-from kconfigs.util import check_call
+from kconfigs.util import download_file
 from kconfigs.util import download_file_mem
-from kconfigs.util import gpg_verify
-from kconfigs.util import maybe_decompress
+from kconfigs.util import gpg_verify_mem
+from kconfigs.util import gpg_verify_tee
 
 
 UPSTREAM_ARCH = {
     "aarch64": "arm64",
 }
 
+# Members of the source tarball which "make defconfig" needs: the Kconfig and
+# Makefile hierarchy, the defconfigs themselves, and the sources of the host
+# tools (fixdep and conf) along with the scripts that Kconfig and the Makefiles
+# call out to. Everything else in the tarball never reaches the disk. GNU tar
+# wildcards match "/", so the leading "*/" covers the top-level directory,
+# whatever its name.
+DEFCONFIG_MEMBERS = [
+    "*/Kconfig*",
+    "*/Makefile*",
+    "*/Kbuild*",
+    "*.include",
+    "*/arch/*/configs/*",
+    "*/arch/*/tools/*.sh",
+    "*/kernel/configs/*",
+    "*/scripts/basic/*",
+    "*/scripts/kconfig/*",
+    "*/scripts/include/*",
+    "*/scripts/dummy-tools/*",
+    "*/scripts/mkmakefile",
+    "*/scripts/*.sh",
+]
+
+# kernel.org publishes a patch from each stable release to the next, which is
+# far smaller than the tarball. When the sparse tree of the previous release of
+# a line is cached, the fetcher picks the patch instead, and the extractor
+# applies it, along with any earlier ones missed, to a copy of the tree.
+KERNEL_ORG = "https://cdn.kernel.org/pub/linux/kernel"
+# The most patches to apply, rather than download the tarball
+MAX_PATCHES = 16
+# About the size of the sparse tree of a recent kernel
+SPARSE_TREE_SIZE = 160 << 20
+# A mainline or stable release, but not a release candidate
+RELEASE_RE = re.compile(r"(\d+)\.(\d+)(?:\.(\d+))?")
+# patch-6.6.1.xz patches 6.6 into 6.6.1, and patch-6.6.52-53.xz patches 6.6.52
+# into 6.6.53
+PATCH_RE = re.compile(r"patch-((\d+\.\d+)(?:\.(\d+))?)(?:-(\d+))?\.xz")
+
+
+def release_line(version: str) -> str | None:
+    """Return the line of a release, e.g. 6.6 for 6.6.53, or None for an rc"""
+    match = RELEASE_RE.fullmatch(version)
+    return f"{match[1]}.{match[2]}" if match else None
+
+
+def sublevel(version: str) -> int:
+    match = RELEASE_RE.fullmatch(version)
+    assert match
+    return int(match[3] or 0)
+
+
+def patch_chain(old: str, new: str) -> list[tuple[str, str]] | None:
+    """
+    Return the steps of the patches from release old to release new, or None
+    if they are not in the same line, or too far apart
+    """
+    line = release_line(new)
+    if line is None or release_line(old) != line:
+        return None
+    start, end = sublevel(old), sublevel(new)
+    if not start < end <= start + MAX_PATCHES:
+        return None
+    versions = [f"{line}.{i}" if i else line for i in range(start, end + 1)]
+    return list(zip(versions, versions[1:]))
+
+
+def patch_url(old: str, new: str) -> str:
+    """Return the URL of the patch from release old to the next one, new"""
+    line = release_line(new)
+    assert line
+    base = f"{KERNEL_ORG}/v{line.split('.')[0]}.x"
+    if old == line:
+        return f"{base}/patch-{new}.xz"
+    return f"{base}/incr/patch-{old}-{sublevel(new)}.xz"
+
+
+def patch_step(name: str) -> tuple[str, str] | None:
+    """Return the releases which a patch goes from and to, by its file name"""
+    match = PATCH_RE.fullmatch(name)
+    if not match:
+        return None
+    release, line, level, incr = match.groups()
+    if incr:
+        return release, f"{line}.{incr}"
+    return line, release
+
+
+def tarball_url(version: str) -> str:
+    major = version.split(".")[0]
+    return f"{KERNEL_ORG}/v{major}.x/linux-{version}.tar.xz"
+
+
+def tree_cache(line: str) -> Path:
+    """The sparse tree of the latest release of a line, kept for patching"""
+    return Extractor.savedir / "upstream-tree" / line
+
+
+def cached_release(line: str) -> str | None:
+    """Return the release of the cached tree of a line, if any"""
+    cache = tree_cache(line)
+    if not cache.is_dir():
+        return None
+    subdirs = list(cache.iterdir())
+    if len(subdirs) != 1 or not subdirs[0].name.startswith("linux-"):
+        return None
+    return subdirs[0].name.removeprefix("linux-")
+
+
+def sparse_patch(patch: bytes) -> bytes:
+    """Return the parts of a patch to files in DEFCONFIG_MEMBERS"""
+    kept = []
+    for part in re.split(rb"^(?=diff )", patch, flags=re.MULTILINE):
+        paths = re.findall(rb"^(?:---|\+\+\+) [ab]/(\S+)", part, re.MULTILINE)
+        if any(
+            fnmatchcase(f"linux/{path.decode()}", member)
+            for path in paths
+            for member in DEFCONFIG_MEMBERS
+        ):
+            kept.append(part)
+    return b"".join(kept)
+
 
 @dataclass
 class UpstreamKernel:
@@ -59,6 +187,8 @@ class UpstreamFetcher(Fetcher):
         self.__last_version: None | str = saved_state.get("last_version")
         self.__latest_version: None | str = None
         self.__latest_url: None | str = None
+        # The tarball, or a patch to the cached tree
+        self.__package_url: None | str = None
         # This is the prefix of the stable release, e.g. 4.14 or 6.5
         assert dc.version is not None
         self.release = dc.version
@@ -97,38 +227,320 @@ class UpstreamFetcher(Fetcher):
         return self.__latest_version != self.__last_version
 
     async def signature_url(self, _: str) -> str | None:
-        assert self.__latest_url
+        assert self.__package_url
         if self.key:
-            tarbase, _ = posixpath.splitext(self.__latest_url)
+            tarbase, _ = posixpath.splitext(self.__package_url)
             return tarbase + ".sign"
         else:
             return None
 
+    async def find_patch(self) -> str | None:
+        """
+        Return the URL of the patch to the latest release from the one before,
+        if the tree of the one before is cached, and the patch exists
+        """
+        assert self.__latest_version
+        line = release_line(self.__latest_version)
+        cached = cached_release(line) if line and self.key else None
+        steps = patch_chain(cached, self.__latest_version) if cached else None
+        if not steps:
+            return None
+        url = patch_url(*steps[-1])
+        try:
+            # The signature is small, and needed anyway
+            await download_file_mem(posixpath.splitext(url)[0] + ".sign")
+        except ClientResponseError as err:
+            if err.status != 404:
+                raise
+            return None
+        return url
+
     async def latest_version_url(self, _: str) -> tuple[str, Checksum | None]:
         assert self.__latest_url
-        return (self.__latest_url, None)
+        if not self.__package_url:
+            self.__package_url = await self.find_patch() or self.__latest_url
+        return (self.__package_url, None)
 
 
 class DefconfigExtractor(Extractor):
+    def footprint(self, size: int, targets: int) -> tuple[int, int]:
+        # The sparse tree is about the size of the compressed tarball, and each
+        # target adds a small object directory and a make process. A patch is
+        # small, but the cached tree it applies to is copied. The rare fallback
+        # to a full extraction is not budgeted for.
+        disk = size + max(size, SPARSE_TREE_SIZE) + targets * (16 << 20)
+        memory = (targets + 1) * (64 << 20)
+        return disk, memory
+
+    def staged_tree(self, package: Path) -> Path:
+        """The directory where verify_signature() extracts the sparse tree"""
+        return package.parent / "defconfig-tree"
+
     async def verify_signature(
         self, package: Path, sig: Path, dc: DistroConfig
     ) -> None:
         if dc.key == "NOVERIFY-GITHUB":
             return
         assert dc.key is not None
-        decompressed_tar = await maybe_decompress(package)
-        if await gpg_verify(decompressed_tar, sig, dc.key):
-            print(f"Good GPG signature [{dc.key}]: {package.name}")
-            # We don't need the tar file, and it takes up too much disk space
-            decompressed_tar.unlink()
-        else:
+        if patch_step(package.name):
+            await self.stage_patched_tree(package, sig, dc)
+            return
+        # kernel.org signs the uncompressed tarball. Decompress it once, and
+        # feed the stream to both gpg and a sparse extraction, which is kept
+        # for extract_kconfigs() only if the signature is good.
+        staging = package.parent / "defconfig-staging"
+        for path in (staging, self.staged_tree(package)):
+            if path.exists():
+                shutil.rmtree(path)
+        staging.mkdir()
+        # tar's errors go to a file: nothing reads a pipe until the whole
+        # tarball is fed, so a full one would stall tar, and the tee with it
+        with tempfile.TemporaryFile() as errors:
+            good, tar = await gpg_verify_tee(
+                package,
+                sig,
+                dc.key,
+                self.tar_command("-", sparse=True),
+                cwd=staging,
+                stdout=DEVNULL,
+                stderr=errors,
+            )
+            code = await tar.wait()
+            errors.seek(0)
+            stderr = errors.read()
+        if not good:
+            shutil.rmtree(staging)
             raise Exception(f"Bad GPG signature [{dc.key}]: {package.name}")
+        print(f"Good GPG signature [{dc.key}]: {package.name}")
+        try:
+            self.check_tar(package, code, stderr, sparse=True)
+        except Exception as e:
+            # extract_kconfigs() will extract the tarball itself
+            print(f"warning: {e}")
+            shutil.rmtree(staging)
+        else:
+            staging.rename(self.staged_tree(package))
+
+    async def fetch_patch(self, old: str, new: str, key: str) -> bytes:
+        """Download the patch from release old to new, and verify it"""
+        url = patch_url(old, new)
+        data, sig = await asyncio.gather(
+            download_file_mem(url),
+            download_file_mem(posixpath.splitext(url)[0] + ".sign"),
+        )
+        return await self.verify_patch(data, sig, key, url)
+
+    async def verify_patch(
+        self, data: bytes, sig: bytes, key: str, name: str
+    ) -> bytes:
+        """Verify a compressed patch, returning it decompressed"""
+        # kernel.org signs the uncompressed patch
+        patch = lzma.decompress(data)
+        if not await gpg_verify_mem(patch, sig, key, name):
+            raise Exception(f"Bad GPG signature [{key}]: {name}")
+        print(f"Good GPG signature [{key}]: {name}")
+        return patch
+
+    async def apply_patch(self, tree: Path, patch: bytes) -> bool:
+        proc = await asyncio.create_subprocess_exec(
+            "patch",
+            "-p1",
+            "--batch",
+            "--forward",
+            "--silent",
+            cwd=tree,
+            stdin=PIPE,
+            stdout=DEVNULL,
+            stderr=DEVNULL,
+        )
+        await proc.communicate(sparse_patch(patch))
+        return await proc.wait() == 0
+
+    async def stage_patched_tree(
+        self, package: Path, sig: Path, dc: DistroConfig
+    ) -> None:
+        """
+        Stage the sparse tree of the release which a patch leads to, for
+        extract_kconfigs(): a copy of the cached tree of an earlier release,
+        with the patch applied, along with any others needed to get from one
+        release to the other. If there is no such chain of patches, or one
+        does not apply, the release's tarball is downloaded instead.
+        """
+        assert dc.key is not None
+        step = patch_step(package.name)
+        assert step
+        new = step[1]
+        line = release_line(new)
+        assert line
+        patch = await self.verify_patch(
+            package.read_bytes(), sig.read_bytes(), dc.key, package.name
+        )
+        staged = self.staged_tree(package)
+        if staged.exists():
+            shutil.rmtree(staged)
+
+        cached = cached_release(line)
+        steps = patch_chain(cached, new) if cached else None
+        if steps and steps[-1] == step:
+            try:
+                patches = [
+                    await self.fetch_patch(*s, dc.key) for s in steps[:-1]
+                ]
+            except ClientResponseError as err:
+                if err.status != 404:
+                    raise
+                print(f"warning: missing patch {err.request_info.url}")
+            else:
+                shutil.copytree(tree_cache(line), staged, symlinks=True)
+                tree = self.tree_root(staged)
+                for p in patches + [patch]:
+                    if not await self.apply_patch(tree, p):
+                        print(f"warning: failed to patch {tree.name}")
+                        shutil.rmtree(staged)
+                        break
+                else:
+                    tree.rename(tree.with_name(f"linux-{new}"))
+                    print(f"Patched {tree.name} into linux-{new}")
+                    return
+
+        tarball = await self.download_tarball(package)
+        await self.verify_signature(tarball, tarball.with_suffix(".sign"), dc)
+
+    async def download_tarball(self, package: Path) -> Path:
+        """Download the tarball of the release which a patch leads to"""
+        step = patch_step(package.name)
+        assert step
+        url = tarball_url(step[1])
+        tarball = package.with_name(posixpath.basename(url))
+        tarbase, _ = posixpath.splitext(url)
+        await asyncio.gather(
+            download_file(url, tarball),
+            download_file(tarbase + ".sign", tarball.with_suffix(".sign")),
+        )
+        return tarball
+
+    def cache_tree(self, staged: Path) -> None:
+        """Keep a verified sparse tree, to patch into the next release"""
+        tree = self.tree_root(staged)
+        release = tree.name.removeprefix("linux-")
+        line = release_line(release)
+        if not tree.name.startswith("linux-") or line is None:
+            return
+        cached = cached_release(line)
+        if cached and sublevel(cached) > sublevel(release):
+            return
+        for objdir in tree.glob("kconfigs-*"):
+            shutil.rmtree(objdir)
+        cache = tree_cache(line)
+        tmp = cache.with_name(cache.name + ".tmp")
+        if tmp.exists():
+            shutil.rmtree(tmp)
+        tmp.parent.mkdir(parents=True, exist_ok=True)
+        shutil.move(staged, tmp)
+        if cache.exists():
+            shutil.rmtree(cache)
+        tmp.rename(cache)
+
+    def tar_command(
+        self, archive: Path | str, sparse: bool
+    ) -> list[str | Path]:
+        cmd: list[str | Path] = ["tar", "xf", archive]
+        ext = compression(Path(archive)) if archive != "-" else None
+        if ext:
+            # tar would use the single-threaded decoder
+            cmd += ["-I", " ".join(decompress_command(ext))]
+        if sparse:
+            cmd += ["--wildcards"] + DEFCONFIG_MEMBERS
+        return cmd
+
+    def check_tar(
+        self, package: Path, code: int, stderr: bytes, sparse: bool
+    ) -> None:
+        # Not every kernel version has a match for every pattern, and tar
+        # reports those as errors. Ignore them, but nothing else.
+        errors = [
+            line
+            for line in stderr.decode().splitlines()
+            if not line.endswith("Not found in archive")
+            and "Exiting with failure status" not in line
+        ]
+        if code != 0 and (errors or not sparse):
+            raise Exception(
+                f"Failed to extract {package.name}:\n" + "\n".join(errors)
+            )
+
+    def tree_root(self, dest: Path) -> Path:
+        subdirs = list(dest.iterdir())
+        assert len(subdirs) == 1
+        return subdirs[0]
+
+    async def extract_tree(
+        self, package: Path, dest: Path, sparse: bool = True
+    ) -> Path:
+        """
+        Extract the kernel source tarball into dest, returning the source tree
+
+        When sparse is true, only the files listed in DEFCONFIG_MEMBERS are
+        extracted, which is a small fraction of the full tree.
+        """
+        proc = await asyncio.create_subprocess_exec(
+            *self.tar_command(package, sparse),
+            cwd=dest,
+            stdout=DEVNULL,
+            stderr=PIPE,
+        )
+        _, stderr = await proc.communicate()
+        self.check_tar(package, await proc.wait(), stderr, sparse)
+        return self.tree_root(dest)
+
+    async def make_defconfig(self, tree: Path, arch: str, objdir: Path) -> bool:
+        proc = await asyncio.create_subprocess_exec(
+            "make",
+            f"O={objdir}",
+            f"ARCH={arch}",
+            "defconfig",
+            cwd=tree,
+            stdout=DEVNULL,
+            stderr=DEVNULL,
+        )
+        return await proc.wait() == 0
+
+    async def make_defconfigs(
+        self, tree: Path, targets: list[tuple[Path, DistroConfig]]
+    ) -> bool:
+        # Each target gets its own output directory. The first one builds the
+        # kconfig host tools, and the rest get a copy of them, which make finds
+        # to be up to date. Then the remaining architectures run in parallel.
+        objdirs = [tree / f"kconfigs-{i}" for i in range(len(targets))]
+        arches = [UPSTREAM_ARCH.get(dc.arch, dc.arch) for _, dc in targets]
+        if not await self.make_defconfig(tree, arches[0], objdirs[0]):
+            return False
+        for objdir in objdirs[1:]:
+            shutil.copytree(
+                objdirs[0] / "scripts", objdir / "scripts", symlinks=True
+            )
+        results = await asyncio.gather(
+            *(
+                self.make_defconfig(tree, arch, objdir)
+                for arch, objdir in zip(arches[1:], objdirs[1:])
+            )
+        )
+        if not all(results):
+            return False
+        for (output, _), objdir in zip(targets, objdirs):
+            shutil.copyfile(objdir / ".config", output)
+        return True
 
     async def extract_kconfig(
         self,
         package: Path,
         output: Path,
         dc: DistroConfig,
+    ) -> None:
+        await self.extract_kconfigs(package, [(output, dc)])
+
+    async def extract_kconfigs(
+        self, package: Path, targets: list[tuple[Path, DistroConfig]]
     ) -> None:
         # The O= inherited in the environment from "make run" is also used in
         # the kernel makefiles. Strip it out here to avoid issues.
@@ -136,23 +548,29 @@ class DefconfigExtractor(Extractor):
             del os.environ["O"]
         if "MAKEFLAGS" in os.environ:
             del os.environ["MAKEFLAGS"]
-        async with TemporaryDirectory() as td:
-            tdpath = Path(td)
-            arch = UPSTREAM_ARCH.get(dc.arch, dc.arch)
-
-            await check_call(
-                ["tar", "xf", package],
-                cwd=tdpath,
-                stdout=DEVNULL,
-                stderr=DEVNULL,
-            )
-            subdirs = list(tdpath.iterdir())
-            assert len(subdirs) == 1
-            extract_dir = subdirs[0]
-            await check_call(
-                ["make", f"ARCH={arch}", "defconfig"],
-                cwd=extract_dir,
-                stdout=DEVNULL,
-                stderr=DEVNULL,
-            )
-            shutil.copyfile(extract_dir / ".config", output)
+        # Try a sparse extraction first. If some tree needs a file which isn't
+        # in DEFCONFIG_MEMBERS, fall back to extracting everything.
+        for sparse in (True, False):
+            async with TemporaryDirectory() as td:
+                staged = self.staged_tree(package)
+                if sparse and staged.exists():
+                    tree = self.tree_root(staged)
+                elif patch_step(package.name):
+                    # A patch was staged, but the full tree is needed
+                    tarball = await self.download_tarball(package)
+                    await self.verify_signature(
+                        tarball, tarball.with_suffix(".sign"), targets[0][1]
+                    )
+                    tree = await self.extract_tree(tarball, Path(td), sparse)
+                else:
+                    tree = await self.extract_tree(package, Path(td), sparse)
+                if await self.make_defconfigs(tree, targets):
+                    if sparse and staged.exists():
+                        self.cache_tree(staged)
+                    return
+            if sparse:
+                print(
+                    f"warning: defconfig failed with sparse extraction of "
+                    f"{package.name}, retrying with the full tree"
+                )
+        raise Exception(f"make defconfig failed for {package.name}")
@@ -1,23 +1,31 @@
 # Copyright (c) 2024, Oracle and/or its affiliates.
 # Licensed under the terms of the GNU General Public License.
 import asyncio
+import contextlib
 import hashlib
 import io
-import posixpath
+import os
+import time
 from asyncio import Semaphore
 from asyncio.subprocess import create_subprocess_exec
 from asyncio.subprocess import PIPE
+from asyncio.subprocess import Process
+from collections import OrderedDict
 from functools import cache
 from pathlib import Path
 from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import TypeVar
 from urllib.parse import urlparse
 
 import aiofiles
-from aiofiles.tempfile import TemporaryDirectory
 from aiohttp import ClientResponseError
 from aiohttp import ClientSession
 from multidict import CIMultiDictProxy
 
+from kconfigs.decompress import decompress_stream
+
 
 HTTPS_HOSTS = {
     "yum.oracle.com",
@@ -27,14 +35,221 @@ HTTPS_HOSTS = {
 }
 
 
+T = TypeVar("T")
+
+
+class MirrorSet:
+    """
+    The mirrors of a repository, which serve the same files under different
+    base URLs. The first is the index named in the config, which the fetchers
+    use in every URL they return, so the rest are interchangeable with it.
+    Files are only trusted by their signatures and checksums, so any mirror
+    is safe to use.
+    """
+
+    # Bytes of the probe file to read from each mirror
+    PROBE_SIZE = 64 << 10
+    # Mirrors are ranked by the seconds they would take to send this much
+    TYPICAL_SIZE = 1 << 20
+    # Seconds before the mirrors are probed again, in a long-running process
+    RERANK_INTERVAL = 6 * 60 * 60
+
+    def __init__(self, urls: list[str], probe: str):
+        self.urls = urls
+        self.probe = probe
+        self.ranked: list[str] | None = None
+        self.ranked_at = 0.0
+
+    def stale(self) -> bool:
+        return (
+            self.ranked is None
+            or time.monotonic() - self.ranked_at > self.RERANK_INTERVAL
+        )
+
+    def demote(self, url: str) -> None:
+        """Move a mirror which failed to the end of the ranking"""
+        if self.ranked and url in self.ranked:
+            self.ranked.remove(url)
+            self.ranked.append(url)
+
+
 class DownloadManager:
     RETRIES = 3
+    # Responses up to this size are kept in memory, the least recently used
+    # dropped first once they total more than the limit. The watch daemon
+    # lives for weeks, so the memo must not grow with every release it sees.
+    MEMO_MAX_SIZE = 4 * 1024 * 1024
+    MEMO_MAX_TOTAL = 64 * 1024 * 1024
 
     def __init__(self, max_downloads: int = 8):
         self.session = ClientSession(raise_for_status=True)
         self.sem = Semaphore(max_downloads)
+        self.inflight: dict[tuple[str, ...], asyncio.Future[Any]] = {}
+        self.memo: OrderedDict[tuple[str, ...], tuple[Any, int]] = OrderedDict()
+        self.memo_size = 0
+        self.mirrors: dict[str, MirrorSet] = {}
+
+    async def single_flight(
+        self, key: tuple[str, ...], request: Callable[[], Awaitable[T]]
+    ) -> T:
+        """
+        Run a request, unless an identical one is already in flight
+
+        Several fetchers may depend on the same URL, such as the upstream
+        fetchers, which all read the kernel.org release feed. Concurrent
+        callers share one request, and all of them receive its result or its
+        exception.
+        """
+        if key in self.memo:
+            self.memo.move_to_end(key)
+            return self.memo[key][0]  # type: ignore
+        fut = self.inflight.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(request())
+            self.inflight[key] = fut
+            fut.add_done_callback(lambda _: self.inflight.pop(key, None))
+        # Shield the shared request, so that one cancelled caller does not
+        # cancel it for the others.
+        return await asyncio.shield(fut)
+
+    def forget(self, prefix: str = "") -> None:
+        """
+        Drop the memoized responses of the URLs starting with a prefix (or all
+        of them), so that later requests see updates
+        """
+        prefixes = [prefix]
+        found = self.mirror_set(prefix.rstrip("/") + "/")
+        if prefix and found:
+            # Responses are memoized under the mirror which sent them, too
+            prefixes += found[1].urls
+        for key in list(self.memo):
+            if key[1].startswith(tuple(prefixes)):
+                self.memo_size -= self.memo.pop(key)[1]
+
+    def remember(self, key: tuple[str, ...], value: Any, size: int) -> None:
+        """
+        Memoize a response, unless it is too large, and evict the least
+        recently used ones beyond the total limit
+        """
+        if size > self.MEMO_MAX_SIZE:
+            return
+        if key in self.memo:
+            self.memo_size -= self.memo.pop(key)[1]
+        self.memo[key] = (value, size)
+        self.memo_size += size
+        while self.memo_size > self.MEMO_MAX_TOTAL:
+            self.memo_size -= self.memo.popitem(last=False)[1][1]
+
+    def add_mirrors(self, index: str, mirrors: list[str], probe: str) -> None:
+        """
+        Serve the URLs under an index from whichever of it and its mirrors is
+        quickest, as measured by reading the probe file (a path relative to
+        the index) from each. The mirrors of an index are only added once.
+        """
+        base = index.rstrip("/") + "/"
+        if mirrors and base not in self.mirrors:
+            urls = [base] + [m.rstrip("/") + "/" for m in mirrors]
+            self.mirrors[base] = MirrorSet(urls, probe)
+
+    def mirror_set(self, url: str) -> tuple[str, MirrorSet] | None:
+        for base, mirrors in self.mirrors.items():
+            if url.startswith(base):
+                return base, mirrors
+        return None
+
+    async def probe(self, url: str) -> float:
+        """
+        Return the estimated seconds for a mirror to send a typical file, from
+        the latency and throughput of a range request for the probe file
+        """
+        size = MirrorSet.PROBE_SIZE
+        headers = {"Range": f"bytes=0-{size - 1}"}
+        try:
+            async with self.sem:
+                start = time.monotonic()
+                async with self.session.get(url, headers=headers) as resp:
+                    first = time.monotonic()
+                    received = 0
+                    # A mirror may ignore the range, and send the whole file
+                    async for chunk in resp.content.iter_chunked(4096):
+                        received += len(chunk)
+                        if received >= size:
+                            break
+                    end = time.monotonic()
+        except Exception as err:
+            print(f"warning: mirror probe {url} failed: {err}")
+            return float("inf")
+        latency = first - start
+        throughput = received / max(end - first, 1e-3)
+        print(
+            f"Probe {url}: {latency * 1000:.0f} ms, "
+            f"{throughput / (1 << 20):.1f} MiB/s"
+        )
+        return latency + MirrorSet.TYPICAL_SIZE / max(throughput, 1)
+
+    async def rank(self, mirrors: MirrorSet) -> list[str]:
+        if mirrors.stale():
+            costs = await asyncio.gather(
+                *(self.probe(url + mirrors.probe) for url in mirrors.urls)
+            )
+            # The index named in the config wins ties, and if all are down
+            ranked = sorted(
+                zip(costs, range(len(costs)), mirrors.urls),
+                key=lambda c: c[:2],
+            )
+            mirrors.ranked = [url for _, _, url in ranked]
+            mirrors.ranked_at = time.monotonic()
+            print(f"Mirrors of {mirrors.urls[0]}: {', '.join(mirrors.ranked)}")
+        assert mirrors.ranked is not None
+        return mirrors.ranked
+
+    async def failover(
+        self, url: str, request: Callable[[str], Awaitable[T]]
+    ) -> T:
+        """
+        Make a request of the best mirror of a URL, and on failure, of each of
+        the others in turn, raising the last error if every mirror fails
+        """
+        found = self.mirror_set(url)
+        if found is None:
+            return await request(url)
+        base, mirrors = found
+        # Between probes, mirrors which fail are moved down the ranking
+        ranked = await self.single_flight(
+            ("PROBE", base), lambda: self.rank(mirrors)
+        )
+        path = url[len(base) :]
+        for i, mirror in enumerate(list(ranked)):
+            try:
+                result = await request(mirror + path)
+            except Exception as err:
+                if i == len(ranked) - 1:
+                    raise
+                print(
+                    f"warning: {mirror + path} failed, trying the next "
+                    f"mirror: {err}"
+                )
+                # A missing file says more about the file than the mirror,
+                # which may just be behind
+                if not (
+                    isinstance(err, ClientResponseError) and err.status == 404
+                ):
+                    mirrors.demote(mirror)
+                continue
+            return result
+        raise AssertionError("unreachable")
 
     async def head(self, url: str) -> CIMultiDictProxy[str]:
+        key = ("HEAD", url)
+        headers = await self.single_flight(
+            key, lambda: self.failover(url, self._head)
+        )
+        self.remember(
+            key, headers, sum(len(k) + len(v) for k, v in headers.items())
+        )
+        return headers
+
+    async def _head(self, url: str) -> CIMultiDictProxy[str]:
         async with self.sem:
             print(f"HTTP HEAD {url}")
             resp = await self.session.head(url)
@@ -47,12 +262,37 @@ class DownloadManager:
         always_download: bool = False,
         checksum: tuple[str, str] | None = None,
     ) -> None:
-        if checksum:
-            h = hashlib.new(checksum[0], usedforsecurity=True)
+        key = ("GET", url, str(file), *(checksum or ()))
+        await self.single_flight(
+            key,
+            lambda: self._download_file(url, file, always_download, checksum),
+        )
+
+    async def _download_file(
+        self,
+        url: str,
+        file: Path,
+        always_download: bool,
+        checksum: tuple[str, str] | None,
+    ) -> None:
         if file.exists() and not always_download:
             # Prevents duplicate work during development
             print(f"Skip download {file}")
             return
+        # A mirror which serves a file that fails its checksum is skipped, as
+        # one which fails to serve it is
+        await self.failover(
+            url, lambda u: self._download_file_from(u, file, checksum)
+        )
+
+    async def _download_file_from(
+        self,
+        url: str,
+        file: Path,
+        checksum: tuple[str, str] | None,
+    ) -> None:
+        if checksum:
+            h = hashlib.new(checksum[0], usedforsecurity=True)
         errors = []
         for i in range(self.RETRIES):
             async with self.sem:
@@ -97,10 +337,40 @@ class DownloadManager:
                 print(f"Verified {checksum[0]} of {url}")
 
     async def download_file_mem(
-        self, url: str, checksum: tuple[str, str] | None = None
+        self,
+        url: str,
+        checksum: tuple[str, str] | None = None,
+        direct: bool = False,
     ) -> bytes:
+        """
+        Download a file into memory. Unless direct is set, it may come from a
+        mirror of the URL.
+        """
+        key: tuple[str, ...]
+        if direct:
+            key = ("GET", url, "direct")
+            data = await self.single_flight(
+                key, lambda: self._download_mem(url)
+            )
+        else:
+            key = ("GET", url)
+            data = await self.single_flight(
+                key, lambda: self.failover(url, self._download_mem)
+            )
+        self.remember(key, data, len(data))
         if checksum:
-            h = hashlib.new(checksum[0])
+            digest = hashlib.new(checksum[0], data).hexdigest()
+            if digest != checksum[1]:
+                raise Exception(
+                    f"Failed to verify {checksum[0]} checksum of {url}:\n"
+                    f"Expected: {checksum[1]}\n",
+                    f"Actual  : {digest}",
+                )
+            else:
+                print(f"Verified {checksum[0]} of {url}")
+        return data
+
+    async def _download_mem(self, url: str) -> bytes:
         errors = []
         for i in range(self.RETRIES):
             out = io.BytesIO()
@@ -108,8 +378,6 @@ class DownloadManager:
                 async with self.sem, self.session.get(url) as resp:
                     print(f"Download {url} to mem [try {i + 1}/{self.RETRIES}]")
                     async for chunk in resp.content.iter_chunked(4096):
-                        if checksum:
-                            h.update(chunk)
                         out.write(chunk)
                 break
             except ClientResponseError as err:
@@ -123,16 +391,6 @@ class DownloadManager:
                 f"Failed to download {url} after {self.RETRIES} retries: "
                 f"{errors}"
             )
-        if checksum:
-            digest = h.hexdigest()
-            if digest != checksum[1]:
-                raise Exception(
-                    f"Failed to verify {checksum[0]} checksum of {url}:\n"
-                    f"Expected: {checksum[1]}\n",
-                    f"Actual  : {digest}",
-                )
-            else:
-                print(f"Verified {checksum[0]} of {url}")
         return out.getvalue()
 
 
@@ -165,6 +423,12 @@ async def head_file(url: str) -> CIMultiDictProxy[str]:
     return await download_manager().head(url)
 
 
+def add_mirrors(index: str, mirrors: str | None, probe: str) -> None:
+    """Add the mirrors of an index, as config.ini lists them, if any"""
+    if mirrors:
+        download_manager().add_mirrors(index, mirrors.split(), probe)
+
+
 async def check_call(
     cmd: list[str | Path], capture_output: bool = False, **kwargs: Any
 ) -> bytes:
@@ -179,30 +443,11 @@ async def check_call(
     return output
 
 
-async def maybe_decompress(file: Path) -> Path:
-    compressors = {
-        "xz": "unxz",
-        "bz2": "bunzip2",
-        "gz": "gunzip",
-        "zst": "unzstd",
-        "zstd": "unzstd",
-    }
-    ext = None
-    split = file.name.rsplit(".", 1)
-    if len(split) == 2:
-        ext = split[1]
-    if not ext or ext not in compressors:
-        return file
-
-    decomp = file.parent / file.name[: -1 - len(ext)]
-    if not decomp.exists():
-        await check_call([compressors[ext], "-kq", file])
-    return decomp
-
-
-async def gpg_verify(file: Path, sig: Path, key: str) -> bool:
+def gpg_command(
+    key: str, sig: str | Path, file: str | Path
+) -> list[str | Path]:
     key_path = Path(__file__).parent.parent.resolve() / f"gpg-keys/{key}.gpg"
-    proc = await create_subprocess_exec(
+    return [
         "/usr/bin/gpg",
         "--no-default-keyring",
         "--keyring",
@@ -210,10 +455,10 @@ async def gpg_verify(file: Path, sig: Path, key: str) -> bool:
         "--verify",
         sig,
         file,
-        stderr=PIPE,
-    )
-    _, stderr = await proc.communicate()
-    code = await proc.wait()
+    ]
+
+
+def gpg_result(code: int, stderr: bytes, key: str, file: str | Path) -> bool:
     # From gpg(1): "the program returns 0 if there are no severe errors, 1 if at
     # least a signature was bad, and other errors codes for fatal errors."
     # Handle 0 and 1 as our desired output (yes/no) and 2 as some other error
@@ -225,6 +470,108 @@ async def gpg_verify(file: Path, sig: Path, key: str) -> bool:
     return code == 0
 
 
+async def gpg_verify(file: Path, sig: Path, key: str) -> bool:
+    proc = await create_subprocess_exec(
+        *gpg_command(key, sig, file), stderr=PIPE
+    )
+    _, stderr = await proc.communicate()
+    return gpg_result(await proc.wait(), stderr, key, file)
+
+
+async def gpg_verify_mem(data: bytes, sig: bytes, key: str, name: str) -> bool:
+    """
+    Verify a signature over data in memory
+
+    The data goes to gpg on stdin, and the signature through a pipe which gpg
+    opens as /dev/fd/N, so neither touches the disk.
+    """
+    rfd, wfd = os.pipe()
+    try:
+        proc = await create_subprocess_exec(
+            *gpg_command(key, f"/dev/fd/{rfd}", "-"),
+            stdin=PIPE,
+            stderr=PIPE,
+            pass_fds=(rfd,),
+        )
+    except BaseException:
+        os.close(wfd)
+        raise
+    finally:
+        os.close(rfd)
+
+    def write_sig() -> None:
+        # If gpg exits early, its exit code says why
+        with contextlib.suppress(BrokenPipeError), os.fdopen(wfd, "wb") as f:
+            f.write(sig)
+
+    # gpg reads the signature before the data, and the write could block if
+    # the signature is larger than the pipe buffer.
+    _, (_, stderr) = await asyncio.gather(
+        asyncio.to_thread(write_sig), proc.communicate(data)
+    )
+    return gpg_result(await proc.wait(), stderr, key, name)
+
+
+async def gpg_verify_tee(
+    file: Path,
+    sig: Path,
+    key: str,
+    sink: list[str | Path],
+    **kwargs: Any,
+) -> tuple[bool, Process]:
+    """
+    Verify the signature over the decompressed contents of a file, and pipe
+    the same contents into a sink command
+
+    This is for signatures over the uncompressed data, like kernel.org's
+    tarball signatures: the file is decompressed only once, and nothing but the
+    sink's own output is written to disk. The caller must wait for the sink,
+    which is returned, and must discard its output if verification fails.
+    """
+    decomp = await decompress_stream(file)
+    procs = [decomp]
+    try:
+        gpg = await create_subprocess_exec(
+            *gpg_command(key, sig, "-"), stdin=PIPE, stderr=PIPE
+        )
+        procs.append(gpg)
+        proc = await create_subprocess_exec(*sink, stdin=PIPE, **kwargs)
+        procs.append(proc)
+        assert gpg.stderr
+
+        async def feed() -> None:
+            assert decomp.stdout and gpg.stdin and proc.stdin
+            sink_open = True
+            try:
+                while chunk := await decomp.stdout.read(1 << 20):
+                    gpg.stdin.write(chunk)
+                    if sink_open:
+                        try:
+                            proc.stdin.write(chunk)
+                            await proc.stdin.drain()
+                        except (BrokenPipeError, ConnectionResetError):
+                            # The sink failed, which the caller will find out
+                            # when it waits for it. Finish the verification
+                            # anyway.
+                            sink_open = False
+                    await gpg.stdin.drain()
+            finally:
+                gpg.stdin.close()
+                proc.stdin.close()
+
+        _, gpg_stderr = await asyncio.gather(feed(), gpg.stderr.read())
+        if await decomp.wait() != 0:
+            raise Exception(f"Failed to decompress {file}")
+        return gpg_result(await gpg.wait(), gpg_stderr, key, file), proc
+    except BaseException:
+        # The caller never gets the sink, so none of them may be left running
+        for p in procs:
+            with contextlib.suppress(ProcessLookupError):
+                p.kill()
+            await p.wait()
+        raise
+
+
 def trusted_url(url: str) -> bool:
     parsed = urlparse(url)
     return parsed.scheme == "https" and parsed.hostname in HTTPS_HOSTS
@@ -233,38 +580,46 @@ def trusted_url(url: str) -> bool:
 async def download_file_mem_verified(
     url: str, key: str | None, https_ok: bool = False, suffix: str = ".asc"
 ) -> bytes:
-    async with TemporaryDirectory() as td:
-        tdpath = Path(td)
-        filename = posixpath.split(url)[-1]
-        file_path = tdpath / filename
-        sig_path = tdpath / f"{filename}{suffix}"
-
-        sig_exists = True
-
-        # start downloading the larger file, but don't wait for it yet
-        file_download = download_file(url, file_path)
+    manager = download_manager()
+
+    async def fetch(source: str) -> bytes:
+        # The file and its signature come from the same mirror, so that they
+        # match: if one mirror is behind, the pair is fetched from the next.
+        # Start downloading the larger file while fetching the signature.
+        file_download = asyncio.create_task(
+            manager.download_file_mem(source, direct=True)
+        )
+        sig: bytes | None = None
         try:
-            await download_file(url + suffix, sig_path)
+            sig = await manager.download_file_mem(source + suffix, direct=True)
         except ClientResponseError as err:
             if err.status != 404:
+                file_download.cancel()
                 raise
-            sig_exists = False
+        except BaseException:
+            file_download.cancel()
+            raise
 
-        await file_download
+        data = await file_download
 
-        if sig_exists:
+        if sig is not None:
             if not key:
                 raise Exception(f"Missing GPG key for {url}")
-            elif not await gpg_verify(file_path, sig_path, key):
-                raise Exception(f"Bad GPG signature: {url}")
+            elif not await gpg_verify_mem(data, sig, key, source):
+                raise Exception(f"Bad GPG signature: {source}")
             else:
-                print(f"Good GPG signature [{key}]: {url}")
+                print(f"Good GPG signature [{key}]: {source}")
         elif https_ok and trusted_url(url):
+            # Only the trusted host itself vouches for unsigned data
+            if not trusted_url(source):
+                print(f"warning: {source} not GPG-signed, fetching {url}")
+                data = await manager.download_file_mem(url, direct=True)
             print(
-                f"warning: {url} not GPG-signed, but fetched from trusted host via HTTPS"
+                f"warning: {url} not GPG-signed, but fetched from trusted host "
+                "via HTTPS"
             )
         else:
-            raise Exception(f"Missing GPG signature: {url}")
+            raise Exception(f"Missing GPG signature: {source}")
+        return data
 
-        async with aiofiles.open(file_path, "rb") as f:
-            return await f.read()
+    return await manager.failover(url, fetch)
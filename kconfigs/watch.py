@@ -0,0 +1,199 @@
+# Copyright (c) 2024, Oracle and/or its affiliates.
+# Licensed under the terms of the GNU General Public License.
+"""
+Keep the configs up to date from a long-running process
+
+Rather than checking every repository on a schedule from a fresh process, this
+keeps the HTTP session, the state and the fetchers' caches around, and checks
+each repository on its own interval. Only the distros of a repository which
+changed go through the pipeline, and the summary is rewritten afterwards.
+"""
+import asyncio
+import configparser
+import random
+import traceback
+from pathlib import Path
+
+from kconfigs.analyzer import summarize
+from kconfigs.extractor import Extractor
+from kconfigs.fetcher import DistroConfig
+from kconfigs.history import History
+from kconfigs.main import argument_parser
+from kconfigs.main import fetcher_key
+from kconfigs.main import FetcherFactory
+from kconfigs.main import get_distros
+from kconfigs.main import Pipeline
+from kconfigs.main import pipeline_options
+from kconfigs.state import State
+from kconfigs.util import download_manager
+
+
+class Watcher:
+    def __init__(
+        self,
+        distros: list[DistroConfig],
+        state: State,
+        fetchers: FetcherFactory,
+        save_dir: Path,
+        out_dir: Path,
+        jobs: dict[str, int],
+        budgets: dict[str, int],
+        summary: Path,
+        interval: float,
+        jitter: float,
+        history: History | None = None,
+    ):
+        self.distros = distros
+        self.state = state
+        self.fetchers = fetchers
+        self.save_dir = save_dir
+        self.out_dir = out_dir
+        self.jobs = jobs
+        self.budgets = budgets
+        self.summary = summary
+        self.interval = interval
+        self.jitter = jitter
+        self.history = history
+        # Distros of changed repositories, with a future to set once they have
+        # been through the pipeline
+        self.changed: asyncio.Queue[
+            tuple[list[DistroConfig], asyncio.Future[None]]
+        ] = asyncio.Queue()
+
+    def repos(self) -> dict[tuple[str, str], list[DistroConfig]]:
+        """Return the distros to update, grouped by the fetcher they share"""
+        repos: dict[tuple[str, str], list[DistroConfig]] = {}
+        for d in self.distros:
+            if d.do_update:
+                repos.setdefault(fetcher_key(d), []).append(d)
+        return repos
+
+    def delay(self, distros: list[DistroConfig]) -> float:
+        intervals = [d.poll_interval for d in distros if d.poll_interval]
+        interval = min(intervals, default=self.interval)
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    async def poll(self, distros: list[DistroConfig]) -> None:
+        # Spread the first checks out over the interval, too
+        await asyncio.sleep(random.uniform(0, self.delay(distros)))
+        while True:
+            self.fetchers.forget(distros[0])
+            # Only this repository's responses: the others' stay warm
+            download_manager().forget(distros[0].index)
+            try:
+                updated = await self.fetchers.get(distros[0]).is_updated()
+            except Exception as e:
+                names = ", ".join(d.unique_name for d in distros)
+                print(f"warning: failed to check {names}: {e!r}")
+                updated = False
+            if updated:
+                done = asyncio.get_running_loop().create_future()
+                await self.changed.put((distros, done))
+                await done
+            await asyncio.sleep(self.delay(distros))
+
+    async def update(self) -> None:
+        while True:
+            batch = [await self.changed.get()]
+            while not self.changed.empty():
+                batch.append(self.changed.get_nowait())
+            distros = [d for distros, _ in batch for d in distros]
+            try:
+                pipeline = Pipeline(
+                    self.fetchers,
+                    self.state,
+                    self.save_dir,
+                    self.out_dir,
+                    self.jobs,
+                    self.budgets,
+                    self.history,
+                )
+                await pipeline.run(distros)
+                if pipeline.done:
+                    # Leave out distros which have yet to get a config
+                    ready = [
+                        d
+                        for d in self.distros
+                        if (self.out_dir / d.unique_name / "config").exists()
+                    ]
+                    print(f"Write summary to {self.summary}")
+                    await asyncio.to_thread(
+                        summarize,
+                        ready,
+                        self.out_dir,
+                        self.summary,
+                        self.save_dir / "analyzer",
+                        "columnar",
+                        self.summary.parent / "summary",
+                        similarity_file=self.summary.parent / "similarity.json",
+                        index_dir=self.summary.parent / "index",
+                        diffs_file=self.summary.parent / "diffs.json",
+                    )
+            except Exception:
+                traceback.print_exc()
+            finally:
+                for _, done in batch:
+                    done.set_result(None)
+
+    async def run(self) -> None:
+        async with asyncio.TaskGroup() as tg:
+            for distros in self.repos().values():
+                tg.create_task(self.poll(distros))
+            tg.create_task(self.update())
+
+
+async def main() -> None:
+    parser = argument_parser("keeps kernel configs up to date")
+    parser.add_argument(
+        "--summary-file",
+        type=Path,
+        help="output JSON file for summarized configs "
+        "(default: summary.json in the output directory)",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=900,
+        help="seconds between checks of each repository, unless its distros "
+        "set poll_interval in the configuration file",
+    )
+    parser.add_argument(
+        "--jitter",
+        type=float,
+        default=0.1,
+        help="fraction by which to randomly vary each interval, so that "
+        "checks do not line up",
+    )
+    args = parser.parse_args()
+    cfg = configparser.ConfigParser()
+    cfg.read(args.config)
+
+    state = State(args.state)
+    distros = get_distros(cfg, args.filter)
+    fetchers = FetcherFactory(state.fetchers, args.download_dir)
+    Extractor.savedir = args.download_dir / "extractor"
+    jobs, budgets = pipeline_options(args)
+    summary = args.summary_file or args.output_dir / "summary.json"
+
+    watcher = Watcher(
+        distros,
+        state,
+        fetchers,
+        args.download_dir,
+        args.output_dir,
+        jobs,
+        budgets,
+        summary,
+        args.interval,
+        args.jitter,
+        History(args.history),
+    )
+    try:
+        await watcher.run()
+    finally:
+        await download_manager().session.close()
+
+
+if __name__ == "__main__":
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())